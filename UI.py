@@ -174,10 +174,14 @@ with container:
 
                 if results:
                     for result in results:
+                        offset = ""
+                        if result.get('offset') is not None:
+                            minutes, seconds = divmod(int(result['offset']), 60)
+                            offset = f" at {minutes}:{seconds:02d}"
                         st.markdown(f"""
                             <div class="result-item">
                                 {result['title']} by {result['artist']} <br>
-                                Match: {result['match']}
+                                Match: {result['match']}{offset}
                             </div>
                         """, unsafe_allow_html=True)
                 else:
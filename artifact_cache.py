@@ -0,0 +1,103 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+HASH_BLOCK_SIZE = 1 << 20
+
+def file_hash(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def array_hash(array):
+    return hashlib.blake2b(memoryview(np.ascontiguousarray(array)).cast('B'), digest_size=16).hexdigest()
+
+def fingerprint(input_hash, params, model_hash=None):
+    # Stable across runs: params are serialized with sorted keys
+    payload = json.dumps({'input': input_hash, 'params': params, 'model': model_hash},
+                         sort_keys=True, default=str)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+class ArtifactManifest:
+    # Append-only JSON lines, one record per finished artifact; the last record for a key wins.
+    # A record is written only after its artifact is complete, so a crash loses at most the
+    # artifact in flight. A torn final line from a crash is dropped on open.
+    def __init__(self, path, params, model_path=None):
+        self.path = path
+        self.params = params
+        self.model_hash = file_hash(model_path) if model_path else None
+        self.records = {}
+        self._hashes = {}
+
+        if os.path.exists(path):
+            self._load()
+        else:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        valid_length = data.rfind(b'\n') + 1
+        if valid_length < len(data):
+            os.truncate(self.path, valid_length)
+
+        for line in data[:valid_length].decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            self.records[record['key']] = record
+            if record.get('input_size') is not None:
+                self._hashes[record['input']] = (record['input_size'], record['input_mtime'], record['input_hash'])
+
+    def input_hash(self, path):
+        # Content hash, reused while the file's size and mtime are unchanged
+        stat = os.stat(path)
+        cached = self._hashes.get(path)
+        if cached and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            return cached[2]
+        digest = file_hash(path)
+        self._hashes[path] = (stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+
+    def is_current(self, key, input_path, output_path=None, input_hash=None):
+        # input_hash overrides hashing input_path, for inputs that are not files of their own
+        record = self.records.get(key)
+        if record is None:
+            return False
+        if input_hash is None:
+            if not os.path.exists(input_path):
+                return False
+            input_hash = self.input_hash(input_path)
+        if record.get('fingerprint') != fingerprint(input_hash, self.params, self.model_hash):
+            return False
+        return output_path is None or os.path.exists(output_path)
+
+    def get(self, key):
+        return self.records.get(key)
+
+    def record(self, key, input_path, input_hash=None, **fields):
+        if input_hash is None:
+            input_hash = self.input_hash(input_path)
+        size, mtime, digest = self._hashes.get(input_path, (None, None, None))
+        if digest != input_hash:
+            size, mtime = None, None
+
+        record = dict(fields, key=key, fingerprint=fingerprint(input_hash, self.params, self.model_hash),
+                      input=input_path, input_size=size, input_mtime=mtime, input_hash=input_hash)
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.records[key] = record
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
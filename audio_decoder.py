@@ -0,0 +1,120 @@
+import os
+import functools
+import subprocess
+import numpy as np
+import soundfile as sf
+import soxr
+
+# soxr quality per tier; 'high' is what librosa.load uses by default
+RESAMPLE_QUALITY = {'low': 'LQ', 'medium': 'MQ', 'high': 'HQ', 'best': 'VHQ'}
+# swr filter precision (bits) per tier when ffmpeg does the resampling
+FFMPEG_PRECISION = {'low': 16, 'medium': 20, 'high': 24, 'best': 28}
+FFMPEG_DEFAULT_SR = 48000
+
+def _ffmpeg_command(file_path, sr, quality):
+    return [
+        'ffmpeg',
+        '-loglevel', 'error',
+        '-i', file_path,
+        '-af', f'aresample=precision={FFMPEG_PRECISION[quality]}',
+        '-f', 'f32le',
+        '-acodec', 'pcm_f32le',
+        '-ac', '1',
+        '-ar', str(sr),
+        'pipe:'
+    ]
+
+def _ffmpeg_blocks(file_path, sr, block_size, quality='high'):
+    process = subprocess.Popen(
+        _ffmpeg_command(file_path, sr, quality),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+
+    try:
+        while True:
+            chunk = process.stdout.read(block_size * 4)
+            if not chunk:
+                break
+            yield np.frombuffer(chunk, dtype=np.float32)
+
+        err = process.stderr.read()
+        if process.wait() != 0:
+            raise RuntimeError(f"FFmpeg error: {err.decode()}")
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+def _soundfile_blocks(file_path, block_size):
+    for block in sf.blocks(file_path, blocksize=block_size, dtype='float32', always_2d=True):
+        yield np.mean(block, axis=1)
+
+def _resampled_blocks(blocks, orig_sr, target_sr, quality):
+    resampler = soxr.ResampleStream(orig_sr, target_sr, 1, dtype='float32', quality=RESAMPLE_QUALITY[quality])
+    for block in blocks:
+        out = resampler.resample_chunk(block)
+        if len(out):
+            yield out
+    out = resampler.resample_chunk(np.empty(0, dtype=np.float32), last=True)
+    if len(out):
+        yield out
+
+class AudioDecoder:
+    # Decodes in-process with libsndfile (wav, flac, ogg, mp3) and resamples to sr with soxr.
+    # Only formats libsndfile cannot read (m4a, aac, ...) fall back to an ffmpeg process per file,
+    # which then resamples to sr itself. sr=None keeps the native rate.
+    def __init__(self, sr=None, quality='high'):
+        if quality not in RESAMPLE_QUALITY:
+            raise ValueError(f"Unknown resample quality: {quality}, expected one of {list(RESAMPLE_QUALITY)}")
+        self.sr = sr
+        self.quality = quality
+        self._unsupported = set()
+
+    def _native_info(self, file_path):
+        # Remembers extensions that are not a libsndfile format at all (m4a, aac, ...) so they skip
+        # straight to ffmpeg. A failure on a supported format may be one corrupt file or an
+        # unsupported codec inside it, so it only sends that file to ffmpeg.
+        extension = os.path.splitext(file_path)[1].lower()
+        if extension in self._unsupported:
+            return None
+        try:
+            return sf.info(file_path)
+        except Exception:
+            if os.path.isfile(file_path) and extension[1:].upper() not in sf.available_formats():
+                self._unsupported.add(extension)
+            return None
+
+    def resample(self, audio, orig_sr):
+        if self.sr is None or orig_sr == self.sr:
+            return audio, orig_sr
+        return soxr.resample(audio, orig_sr, self.sr, quality=RESAMPLE_QUALITY[self.quality]), self.sr
+
+    def decode(self, file_path):
+        # Returns (mono float32 audio, sr)
+        if self._native_info(file_path) is not None:
+            audio, sr = sf.read(file_path, dtype='float32', always_2d=True)
+            return self.resample(np.mean(audio, axis=1) if audio.shape[1] > 1 else audio[:, 0], sr)
+
+        sr = self.sr or FFMPEG_DEFAULT_SR
+        process = subprocess.run(_ffmpeg_command(file_path, sr, self.quality), capture_output=True)
+        if process.returncode != 0:
+            raise RuntimeError(f"Failed to load audio file {file_path}: FFmpeg error: {process.stderr.decode()}")
+        return np.frombuffer(process.stdout, dtype=np.float32), sr
+
+    def stream(self, file_path, block_size):
+        # Returns (blocks, sr); blocks yields mono float32 arrays
+        info = self._native_info(file_path)
+        if info is not None:
+            blocks = _soundfile_blocks(file_path, block_size)
+            if self.sr is None or self.sr == info.samplerate:
+                return blocks, info.samplerate
+            return _resampled_blocks(blocks, info.samplerate, self.sr, self.quality), self.sr
+
+        sr = self.sr or FFMPEG_DEFAULT_SR
+        return _ffmpeg_blocks(file_path, sr, block_size, self.quality), sr
+
+@functools.lru_cache(maxsize=None)
+def get_decoder(sr=None, quality='high'):
+    # One decoder per process and configuration, reused across files
+    return AudioDecoder(sr, quality)
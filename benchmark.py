@@ -0,0 +1,172 @@
+import argparse
+import time
+import numpy as np
+import torch
+from librosa.filters import mel as librosa_mel_fn
+from process_audio_3 import MelFrontend
+
+def reference_process_audio(audio, sr=22050, n_mels=80, n_fft=1024, hop_length=256, win_length=1024,
+                            fmin=0.0, fmax=8000.0):
+    # Per-call implementation that MelFrontend replaced, kept as the parity reference
+    waveform = torch.FloatTensor(audio)
+    mel_basis = librosa_mel_fn(sr=sr, n_fft=n_fft, n_mels=n_mels, fmin=fmin, fmax=fmax)
+    mel_basis = torch.from_numpy(mel_basis).float()
+
+    spec = torch.stft(
+        waveform,
+        n_fft=n_fft,
+        hop_length=hop_length,
+        win_length=win_length,
+        window=torch.hann_window(win_length),
+        return_complex=True
+    )
+    spec = torch.abs(spec)
+    mel = torch.matmul(mel_basis, spec)
+    mel = torch.log(torch.clamp(mel, min=1e-5))
+
+    return mel.numpy()
+
+def random_clips(num_clips, min_seconds, max_seconds, sr=22050, seed=1234):
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(int(min_seconds * sr), int(max_seconds * sr), size=num_clips)
+    return [rng.standard_normal(length).astype(np.float32) * 0.1 for length in lengths]
+
+def check_mel_parity(clips, frontend, atol=1e-4):
+    batched = frontend.process_batch(clips)
+    max_error = 0.0
+    for clip, spec in zip(clips, batched):
+        expected = reference_process_audio(clip, sr=frontend.sr)
+        if expected.shape != spec.shape:
+            raise AssertionError(f"Shape mismatch: {spec.shape} vs {expected.shape}")
+        max_error = max(max_error, float(np.abs(expected - spec).max()))
+
+    if max_error > atol:
+        raise AssertionError(f"Mel parity failed: max abs error {max_error:.2e} > {atol:.0e}")
+
+    print(f"Mel parity OK on {len(clips)} clips (max abs error {max_error:.2e})")
+    return max_error
+
+def benchmark_mel_frontend(num_clips=64, min_seconds=5.0, max_seconds=15.0, batch_size=16, repeats=3):
+    frontend = MelFrontend()
+    clips = random_clips(num_clips, min_seconds, max_seconds, sr=frontend.sr)
+    check_mel_parity(clips[:8], frontend)
+
+    total_seconds = sum(len(clip) for clip in clips) / frontend.sr
+
+    def run_reference():
+        for clip in clips:
+            reference_process_audio(clip, sr=frontend.sr)
+
+    def run_single():
+        for clip in clips:
+            frontend(clip)
+
+    def run_batched():
+        for start in range(0, len(clips), batch_size):
+            frontend.process_batch(clips[start:start + batch_size])
+
+    print(f"{'mode':<24}{'seconds':>10}{'audio s/s':>12}")
+    for name, fn in [("reference", run_reference),
+                     ("frontend", run_single),
+                     (f"frontend batch={batch_size}", run_batched)]:
+        fn()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            fn()
+        elapsed = (time.perf_counter() - start) / repeats
+        print(f"{name:<24}{elapsed:>10.3f}{total_seconds / elapsed:>12.1f}")
+
+def benchmark_search(concurrency=8, num_queries=64, seconds=8.0, max_wait=0.002):
+    from concurrent.futures import ThreadPoolExecutor
+    from search import SearchEngine
+
+    # Distinct clips and no result cache, so every query reaches the model and the index
+    engine = SearchEngine(cache_size=0, max_wait=max_wait)
+    clips = random_clips(num_queries, seconds, seconds + 0.5)
+    engine.search(clips[0], 22050)
+
+    print(f"{'mode':<16}{'p50 ms (1 client)':>20}{f'QPS ({concurrency} clients)':>20}{'avg batch':>12}")
+    for name, max_batch in [("unbatched", 1), ("micro-batched", 32)]:
+        engine.batcher.max_batch = max_batch
+
+        latencies = []
+        for clip in clips[:16]:
+            start = time.perf_counter()
+            engine.search(clip, 22050)
+            latencies.append(time.perf_counter() - start)
+
+        batches, items = engine.batcher.batches, engine.batcher.items
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(lambda clip: engine.search(clip, 22050), clips))
+        elapsed = time.perf_counter() - start
+        avg_batch = (engine.batcher.items - items) / max(1, engine.batcher.batches - batches)
+
+        print(f"{name:<16}{np.median(latencies) * 1000:>20.1f}{len(clips) / elapsed:>20.1f}{avg_batch:>12.1f}")
+
+def benchmark_model(model_path=None, batch_sizes=(1, 32), repeats=5, compile_model=False):
+    from export_model import load_checkpoint
+    from inference_optimize import optimize_for_inference, bf16_supported
+    from train_model_3 import ResNetFace
+
+    # Random weights without a checkpoint: latency does not depend on the values
+    model = load_checkpoint(model_path) if model_path else ResNetFace().eval()
+    variants = [("eager", model),
+                ("folded", optimize_for_inference(model, channels_last=False)),
+                ("folded+channels_last", optimize_for_inference(model))]
+    if bf16_supported():
+        variants.append(("+bf16", optimize_for_inference(model, bf16=True)))
+    else:
+        print("CPU has no native bf16, skipping the bf16 variant")
+    if compile_model:
+        variants.append(("+compile", optimize_for_inference(model, bf16=None, compile_model=True)))
+
+    inputs = torch.randn((max(batch_sizes), 1, 80, 630))
+    with torch.no_grad():
+        reference = model(inputs)
+
+    header = "".join(f"{f'ms/query b={b}':>16}" for b in batch_sizes)
+    print(f"{'mode':<24}{header}{'max abs err':>14}")
+    for name, variant in variants:
+        with torch.no_grad():
+            error = float((variant(inputs) - reference).abs().max())
+            timings = []
+            for batch_size in batch_sizes:
+                batch = inputs[:batch_size]
+                variant(batch)
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    variant(batch)
+                timings.append((time.perf_counter() - start) / repeats / batch_size * 1000)
+        print(f"{name:<24}" + "".join(f"{t:>16.1f}" for t in timings) + f"{error:>14.2e}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Melodeez benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    mel_parser = subparsers.add_parser("mel", help="Mel frontend parity and throughput")
+    mel_parser.add_argument("--num-clips", type=int, default=64)
+    mel_parser.add_argument("--batch-size", type=int, default=16)
+    mel_parser.add_argument("--repeats", type=int, default=3)
+
+    search_parser = subparsers.add_parser("search", help="Query latency and throughput with micro-batching")
+    search_parser.add_argument("--concurrency", type=int, default=8)
+    search_parser.add_argument("--num-queries", type=int, default=64)
+    search_parser.add_argument("--max-wait", type=float, default=0.002)
+
+    model_parser = subparsers.add_parser("model", help="Eager vs inference-optimized ResNetFace latency")
+    model_parser.add_argument("--model", help="Checkpoint to load; random weights when omitted")
+    model_parser.add_argument("--repeats", type=int, default=5)
+    model_parser.add_argument("--compile", action="store_true", help="Also time torch.compile (slow warm-up)")
+
+    args = parser.parse_args()
+
+    if args.command == "mel":
+        benchmark_mel_frontend(num_clips=args.num_clips, batch_size=args.batch_size, repeats=args.repeats)
+    elif args.command == "search":
+        benchmark_search(concurrency=args.concurrency, num_queries=args.num_queries, max_wait=args.max_wait)
+    elif args.command == "model":
+        benchmark_model(args.model, repeats=args.repeats, compile_model=args.compile)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+import os
+import io
+import csv
+import json
+import numpy as np
+
+class EmbeddingStore:
+    # One contiguous row-major matrix file plus sidecars:
+    #   <name>.bin          embeddings, appended row blocks
+    #   <name>_offsets.bin  float32 time offset (seconds) of every row
+    #   <name>.json         dim and dtype
+    #   <name>.csv          id, song, info, start, count per song; a row here commits the block
+    # Appending a song again supersedes its earlier block, which stays on disk until reset().
+    # An index row with count 0 removes its song.
+    FIELDNAMES = ['id', 'song', 'info', 'start', 'count']
+
+    # dtype=None opens an existing store as stored and creates a new one as float32
+    def __init__(self, folder, name='embeddings', dim=512, dtype=None):
+        self.folder = folder
+        self.data_path = os.path.join(folder, f"{name}.bin")
+        self.offsets_path = os.path.join(folder, f"{name}_offsets.bin")
+        self.header_path = os.path.join(folder, f"{name}.json")
+        self.index_path = os.path.join(folder, f"{name}.csv")
+
+        if os.path.exists(self.header_path):
+            with open(self.header_path, 'r', encoding='utf-8') as f:
+                header = json.load(f)
+            self.dim = header['dim']
+            self.dtype = np.dtype(header['dtype'])
+            if dtype is not None and np.dtype(dtype) != self.dtype:
+                raise ValueError(f"{self.header_path} stores {self.dtype.name} embeddings, not {np.dtype(dtype).name}: "
+                                 f"delete the store to rebuild it as {np.dtype(dtype).name}")
+        else:
+            os.makedirs(folder, exist_ok=True)
+            self.dim = dim
+            self.dtype = np.dtype(dtype or 'float32')
+            if self.dtype not in (np.float32, np.float16):
+                raise ValueError(f"Unsupported embedding dtype: {self.dtype}")
+            with open(self.header_path, 'w', encoding='utf-8') as f:
+                json.dump({'dim': self.dim, 'dtype': self.dtype.name}, f)
+            with open(self.index_path, 'w', newline='', encoding='utf-8') as f:
+                csv.DictWriter(f, fieldnames=self.FIELDNAMES).writeheader()
+
+        rows = self._read_index()
+        self.num_rows = sum(row['count'] for row in rows)
+        self._latest = {}
+        for row in rows:
+            if row['count']:
+                self._latest[row['song']] = row
+            else:
+                self._latest.pop(row['song'], None)
+        self.entries = [row for row in rows if self._latest.get(row['song']) is row]
+        self._matrix = None
+        self._writable = False
+
+    def _read_index(self):
+        # Rows up to the last newline are committed; bytes after it are a row torn by a crash
+        with open(self.index_path, 'rb') as f:
+            data = f.read()
+        self._index_length = data.rfind(b'\n') + 1
+
+        rows = []
+        for row in csv.DictReader(io.StringIO(data[:self._index_length].decode('utf-8'), newline='')):
+            row['start'] = int(row['start'])
+            row['count'] = int(row['count'])
+            rows.append(row)
+        return rows
+
+    def _open_for_write(self):
+        # Only writers clean up after a crashed append; readers never touch the files, so
+        # opening a store cannot cut off another process's append in flight
+        if self._writable:
+            return
+        if os.path.getsize(self.index_path) > self._index_length:
+            os.truncate(self.index_path, self._index_length)
+        self._truncate_uncommitted()
+        self._writable = True
+
+    def _truncate_uncommitted(self):
+        # Drop rows written by an append that crashed before its index row
+        for path, row_bytes in ((self.data_path, self.dim * self.dtype.itemsize), (self.offsets_path, 4)):
+            if os.path.exists(path) and os.path.getsize(path) > self.num_rows * row_bytes:
+                os.truncate(path, self.num_rows * row_bytes)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, song):
+        return song in self._latest
+
+    def _live_rows(self):
+        # None when no block is superseded, so callers can use the memmap as is
+        if sum(entry['count'] for entry in self.entries) == self.num_rows:
+            return None
+        return np.concatenate([np.arange(entry['start'], entry['start'] + entry['count'])
+                               for entry in self.entries]) if self.entries else np.empty(0, dtype=np.int64)
+
+    def append(self, items):
+        # items: iterable of (id, song, info, embeddings[count, dim], offsets[count] or None)
+        blocks, offsets, rows = [], [], []
+        start = self.num_rows
+        for song_id, song, info, embeddings, song_offsets in items:
+            embeddings = np.asarray(embeddings).reshape(-1, self.dim)
+            if song_offsets is None:
+                song_offsets = np.zeros(len(embeddings), dtype=np.float32)
+            blocks.append(embeddings.astype(self.dtype, copy=False))
+            offsets.append(np.asarray(song_offsets, dtype=np.float32))
+            rows.append({'id': song_id, 'song': song, 'info': info, 'start': start, 'count': len(embeddings)})
+            start += len(embeddings)
+
+        if not rows:
+            return
+
+        self._open_for_write()
+        with open(self.data_path, 'ab') as f:
+            for block in blocks:
+                f.write(np.ascontiguousarray(block).tobytes())
+        with open(self.offsets_path, 'ab') as f:
+            for block in offsets:
+                f.write(block.tobytes())
+        with open(self.index_path, 'a', newline='', encoding='utf-8') as f:
+            csv.DictWriter(f, fieldnames=self.FIELDNAMES).writerows(rows)
+            f.flush()
+            self._index_length = f.buffer.tell()
+
+        for row in rows:
+            previous = self._latest.get(row['song'])
+            if previous is not None:
+                self.entries.remove(previous)
+            self._latest[row['song']] = row
+            self.entries.append(row)
+        self.num_rows = start
+        self._matrix = None
+
+    def remove(self, songs):
+        # Tombstone rows, so removal commits the same way an append does
+        rows = [{'id': self._latest[song]['id'], 'song': song, 'info': '', 'start': self.num_rows, 'count': 0}
+                for song in dict.fromkeys(songs) if song in self._latest]
+        if not rows:
+            return 0
+
+        self._open_for_write()
+        with open(self.index_path, 'a', newline='', encoding='utf-8') as f:
+            csv.DictWriter(f, fieldnames=self.FIELDNAMES).writerows(rows)
+            f.flush()
+            self._index_length = f.buffer.tell()
+
+        for row in rows:
+            self.entries.remove(self._latest.pop(row['song']))
+        return len(rows)
+
+    @property
+    def embeddings(self):
+        if self._matrix is None:
+            if self.num_rows == 0:
+                return np.empty((0, self.dim), dtype=self.dtype)
+            self._matrix = np.memmap(self.data_path, dtype=self.dtype, mode='r', shape=(self.num_rows, self.dim))
+        return self._matrix
+
+    @property
+    def offsets(self):
+        if self.num_rows == 0:
+            return np.empty(0, dtype=np.float32)
+        offsets = np.memmap(self.offsets_path, dtype=np.float32, mode='r', shape=(self.num_rows,))
+        live_rows = self._live_rows()
+        return offsets if live_rows is None else offsets[live_rows]
+
+    def row_ids(self):
+        return np.repeat(np.array([entry['id'] for entry in self.entries], dtype=object),
+                         [entry['count'] for entry in self.entries])
+
+    def get(self, song):
+        entry = self._latest[song]
+        return self.embeddings[entry['start']:entry['start'] + entry['count']]
+
+    def as_float32(self):
+        # Zero-copy for float32 stores without superseded blocks, one copy otherwise
+        live_rows = self._live_rows()
+        if live_rows is None:
+            return np.asarray(self.embeddings, dtype=np.float32)
+        return np.asarray(self.embeddings[live_rows], dtype=np.float32)
+
+    def reset(self):
+        # Drop every block; the emptied index goes first so a crash leaves rows to truncate
+        with open(self.index_path, 'w', newline='', encoding='utf-8') as f:
+            csv.DictWriter(f, fieldnames=self.FIELDNAMES).writeheader()
+            f.flush()
+            self._index_length = f.buffer.tell()
+        self.entries = []
+        self._latest = {}
+        self.num_rows = 0
+        self._matrix = None
+        self._truncate_uncommitted()
+        self._writable = True
+
+    @staticmethod
+    def exists(folder, name='embeddings'):
+        return os.path.exists(os.path.join(folder, f"{name}.json"))
+
+def overrides_path(folder, name='embeddings'):
+    return os.path.join(folder, f"{name}_overrides.json")
+
+def read_overrides(folder, name='embeddings'):
+    # (removed, updated) song ids edited through index_maintenance. The catalog pipeline leaves
+    # them alone, so a rerun neither brings a removed song back nor adds a second copy of an update.
+    path = overrides_path(folder, name)
+    if not os.path.exists(path):
+        return set(), set()
+    with open(path, 'r', encoding='utf-8') as f:
+        overrides = json.load(f)
+    return set(overrides['removed']), set(overrides['updated'])
+
+def write_overrides(folder, name, removed, updated):
+    path = overrides_path(folder, name)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'removed': sorted(removed), 'updated': sorted(updated)}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
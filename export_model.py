@@ -0,0 +1,282 @@
+import os
+import csv
+import copy
+import json
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from train_model_2 import Config
+from train_model_3 import ResNetFace, read_val, fit_input, mrr_from_features
+from inference_2 import preprocess_mel, load_exported_model
+
+FORMATS = ('torchscript', 'onnx')
+QUANTIZATIONS = ('none', 'dynamic', 'static')
+
+def load_checkpoint(model_path, feature_dim=512):
+    # Plain CPU eval model; DataParallel checkpoints have every key prefixed with 'module.'
+    state_dict = torch.load(model_path, map_location='cpu', weights_only=True)
+    if all(k.startswith('module.') for k in state_dict.keys()):
+        state_dict = {k[len('module.'):]: v for k, v in state_dict.items()}
+
+    model = ResNetFace(feature_dim=feature_dim)
+    model.load_state_dict(state_dict, strict=True)
+    model.eval()
+    return model
+
+def sample_mels(data_folder, num_samples, input_shape, seed=0):
+    # Random sample of catalog mels from output6, resized like EmbeddingGenerator.preprocess
+    mel_folder = os.path.join(data_folder, "output6")
+    with open(os.path.join(mel_folder, "metadata.csv"), newline='', encoding='utf-8') as f:
+        songs = [row['song'] for row in csv.DictReader(f)]
+    paths = [os.path.join(mel_folder, "song", song) for song in songs]
+    paths = [path for path in paths if os.path.exists(path)]
+    if not paths:
+        raise RuntimeError(f"No mels found in {mel_folder}")
+
+    rng = np.random.default_rng(seed)
+    chosen = rng.choice(len(paths), size=min(num_samples, len(paths)), replace=False)
+    return torch.cat([preprocess_mel(np.load(paths[i]), input_shape) for i in sorted(chosen)])
+
+def pooling_matrix(in_size, out_size):
+    # Row i averages the same input window adaptive_avg_pool uses for output i
+    matrix = torch.zeros(out_size, in_size)
+    for i in range(out_size):
+        start = (i * in_size) // out_size
+        end = -(-((i + 1) * in_size) // out_size)
+        matrix[i, start:end] = 1.0 / (end - start)
+    return matrix
+
+class MatmulAvgPool2d(nn.Module):
+    # AdaptiveAvgPool2d for one fixed input size as two matmuls. The ONNX exporter rejects
+    # adaptive pooling whose output size does not divide the input (layer4 is 20x3 -> 10x10).
+    def __init__(self, input_size, output_size):
+        super().__init__()
+        self.register_buffer('rows', pooling_matrix(input_size[0], output_size[0]))
+        self.register_buffer('cols', pooling_matrix(input_size[1], output_size[1]).t().contiguous())
+
+    def forward(self, x):
+        return torch.matmul(torch.matmul(self.rows, x), self.cols)
+
+def with_fixed_pooling(model, input_shape):
+    model = copy.deepcopy(model)
+    pool_input = {}
+
+    def record_size(module, args):
+        pool_input['size'] = tuple(args[0].shape[2:])
+
+    hook = model.avgpool.register_forward_pre_hook(record_size)
+    with torch.no_grad():
+        model(torch.zeros((1,) + tuple(input_shape)))
+    hook.remove()
+    model.avgpool = MatmulAvgPool2d(pool_input['size'], model.avgpool.output_size)
+    return model
+
+class FloatPReLU(nn.Module):
+    # Kept out of static quantization: the quantized prelu kernel mis-applies per-channel
+    # slopes (cosine ~0.2 vs fp32), and FX cannot leave an nn.PReLU unquantized
+    def __init__(self, prelu):
+        super().__init__()
+        self.weight = prelu.weight
+
+    def forward(self, x):
+        return F.prelu(x, self.weight)
+
+def float_prelus(module):
+    for name, child in module.named_children():
+        if isinstance(child, nn.PReLU):
+            setattr(module, name, FloatPReLU(child))
+        else:
+            float_prelus(child)
+    return module
+
+def quantize_torch(model, quantization, calibration, batch_size=32):
+    if quantization == 'dynamic':
+        # Only the 12800x512 fc5 is quantized; convolutions stay fp32
+        return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8), None
+
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+    engine = 'x86' if 'x86' in torch.backends.quantized.supported_engines else 'fbgemm'
+    torch.backends.quantized.engine = engine
+
+    qconfig_mapping = get_default_qconfig_mapping(engine).set_object_type(FloatPReLU, None)
+    custom_config = PrepareCustomConfig().set_non_traceable_module_classes([FloatPReLU])
+    prepared = prepare_fx(float_prelus(copy.deepcopy(model)), qconfig_mapping, (calibration[:1],),
+                          prepare_custom_config=custom_config)
+    with torch.no_grad():
+        for start in range(0, len(calibration), batch_size):
+            prepared(calibration[start:start + batch_size])
+    return convert_fx(prepared), engine
+
+class _CalibrationReader:
+    # onnxruntime.quantization data reader over the calibration mels
+    def __init__(self, input_name, calibration, batch_size=32):
+        self._batches = iter([{input_name: calibration[start:start + batch_size].numpy()}
+                              for start in range(0, len(calibration), batch_size)])
+
+    def get_next(self):
+        return next(self._batches, None)
+
+    def rewind(self):
+        pass
+
+def export_torchscript(model, output_path, example):
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+        traced = torch.jit.freeze(traced)
+    traced.save(output_path)
+
+def export_onnx(model, output_path, example, quantization, calibration):
+    model = with_fixed_pooling(model, example.shape[1:])
+    fp32_path = output_path if quantization == 'none' else f"{os.path.splitext(output_path)[0]}.fp32.onnx"
+    torch.onnx.export(model, example, fp32_path, input_names=['mel'], output_names=['embedding'],
+                      dynamic_axes={'mel': {0: 'batch'}, 'embedding': {0: 'batch'}}, opset_version=17, dynamo=False)
+    if quantization == 'none':
+        return
+
+    try:
+        from onnxruntime.quantization import quantize_dynamic, quantize_static, QuantType
+    except ImportError:
+        raise ImportError("int8 ONNX export requires onnxruntime (pip install onnxruntime)")
+    if quantization == 'dynamic':
+        quantize_dynamic(fp32_path, output_path, weight_type=QuantType.QInt8)
+    else:
+        quantize_static(fp32_path, output_path, _CalibrationReader('mel', calibration),
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    os.remove(fp32_path)
+
+def embed(model, inputs, batch_size=32):
+    with torch.no_grad():
+        return torch.cat([model(inputs[start:start + batch_size]) for start in range(0, len(inputs), batch_size)]).numpy()
+
+def cosine_similarity(a, b):
+    a = a / np.maximum(np.linalg.norm(a, axis=1, keepdims=True), 1e-12)
+    b = b / np.maximum(np.linalg.norm(b, axis=1, keepdims=True), 1e-12)
+    return np.sum(a * b, axis=1)
+
+def load_val_inputs(val_list, data_root, input_shape, max_items=None):
+    # Validation hums and songs cropped/padded like calculate_mrr
+    items = read_val(val_list, data_root)[:max_items]
+    items = [item for item in items if os.path.exists(item['path'])]
+    inputs = torch.stack([torch.from_numpy(np.asarray(fit_input(np.load(item['path']), input_shape[1:]),
+                                                      dtype=np.float32)).unsqueeze(0) for item in items])
+    return items, inputs
+
+def val_mrr(items, embeddings):
+    songs = [i for i, item in enumerate(items) if item['type'] == 'song']
+    hums = [i for i, item in enumerate(items) if item['type'] != 'song']
+    if not songs or not hums:
+        return None
+    return mrr_from_features(np.ascontiguousarray(embeddings[songs]), [items[i]['id'] for i in songs],
+                             np.ascontiguousarray(embeddings[hums]), [items[i]['id'] for i in hums])
+
+def measure_latency(model, input_shape, batch_size, repeats=10):
+    inputs = torch.randn((batch_size,) + tuple(input_shape))
+    with torch.no_grad():
+        model(inputs)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            model(inputs)
+    return (time.perf_counter() - start) / repeats * 1000
+
+def parity_report(reference, exported, mels, val=None, batch_sizes=(1, 32), repeats=10):
+    input_shape = tuple(mels.shape[1:])
+    report = {}
+
+    similarity = cosine_similarity(embed(reference, mels), embed(exported, mels))
+    report['cosine_mean'] = float(similarity.mean())
+    report['cosine_min'] = float(similarity.min())
+    print(f"Cosine similarity vs fp32 over {len(mels)} mels: mean {report['cosine_mean']:.4f}, min {report['cosine_min']:.4f}")
+
+    if val is not None:
+        items, inputs = val
+        reference_mrr = val_mrr(items, embed(reference, inputs))
+        exported_mrr = val_mrr(items, embed(exported, inputs))
+        if reference_mrr is not None:
+            report['mrr_fp32'] = reference_mrr
+            report['mrr_exported'] = exported_mrr
+            report['mrr_delta'] = exported_mrr - reference_mrr
+            print(f"Validation MRR: fp32 {reference_mrr:.4f}, exported {exported_mrr:.4f}, "
+                  f"delta {report['mrr_delta']:+.4f}")
+
+    print(f"{'batch':<8}{'fp32 ms':>12}{'exported ms':>14}{'speedup':>10}")
+    for batch_size in batch_sizes:
+        reference_ms = measure_latency(reference, input_shape, batch_size, repeats)
+        exported_ms = measure_latency(exported, input_shape, batch_size, repeats)
+        report[f'latency_ms_batch{batch_size}'] = {'fp32': reference_ms, 'exported': exported_ms}
+        print(f"{batch_size:<8}{reference_ms:>12.1f}{exported_ms:>14.1f}{reference_ms / exported_ms:>9.2f}x")
+    return report
+
+def export_model(model_path, output_path, export_format='torchscript', quantization='none',
+                 data_folder='output', num_calibration=256, num_parity=64, val_list=None, val_root=None,
+                 max_val_items=None, repeats=10):
+    config = Config()
+    input_shape = config.input_shape
+    model = load_checkpoint(model_path, config.embedding_dim)
+
+    calibration = None
+    if quantization == 'static':
+        print(f"Calibrating on up to {num_calibration} mels from {data_folder}/output6")
+        calibration = sample_mels(data_folder, num_calibration, input_shape, seed=0)
+    example = torch.zeros((1,) + tuple(input_shape))
+
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    engine = None
+    if export_format == 'torchscript':
+        exported = model
+        if quantization != 'none':
+            exported, engine = quantize_torch(model, quantization, calibration)
+        export_torchscript(exported, output_path, example)
+    else:
+        export_onnx(model, output_path, example, quantization, calibration)
+
+    info = {'format': export_format, 'quantization': quantization, 'engine': engine,
+            'input_shape': list(input_shape), 'checkpoint': model_path}
+    print(f"Exported {export_format} ({quantization}) model to {output_path}")
+
+    try:
+        exported = load_exported_model(output_path, export_format)
+    except ImportError as e:
+        print(f"Skipping parity check: {e}")
+        exported = None
+
+    if exported is not None:
+        # Parity mels use a different seed from calibration so the check is not on seen data
+        mels = sample_mels(data_folder, num_parity, input_shape, seed=1)
+        val = None
+        val_list = val_list or config.val_list
+        if os.path.exists(val_list):
+            val = load_val_inputs(val_list, val_root or config.train_root, input_shape, max_val_items)
+        info['parity'] = parity_report(model, exported, mels, val, repeats=repeats)
+
+    with open(f"{output_path}.json", 'w', encoding='utf-8') as f:
+        json.dump(info, f, indent=2)
+    return info
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a ResNetFace checkpoint for CPU inference")
+    parser.add_argument("--model", default=os.path.join("checkpoints", "resnetface_best.pth"))
+    parser.add_argument("--output", help="Defaults to checkpoints/resnetface_<quantization>.<pt|onnx>")
+    parser.add_argument("--format", dest="export_format", choices=FORMATS, default="torchscript")
+    parser.add_argument("--quantize", dest="quantization", choices=QUANTIZATIONS, default="none")
+    parser.add_argument("--data-folder", default="output", help="Folder holding output6 mels for calibration")
+    parser.add_argument("--num-calibration", type=int, default=256)
+    parser.add_argument("--num-parity", type=int, default=64)
+    parser.add_argument("--val-list", help="Defaults to Config.val_list")
+    parser.add_argument("--val-root", help="Defaults to Config.train_root")
+    parser.add_argument("--max-val-items", type=int)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    output = args.output or os.path.join(
+        "checkpoints", f"resnetface_{args.quantization}.{'pt' if args.export_format == 'torchscript' else 'onnx'}")
+    export_model(args.model, output, args.export_format, args.quantization, args.data_folder,
+                 args.num_calibration, args.num_parity, args.val_list, args.val_root, args.max_val_items,
+                 args.repeats)
+
+if __name__ == "__main__":
+    main()
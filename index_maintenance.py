@@ -0,0 +1,253 @@
+import os
+import csv
+import json
+import argparse
+import faiss
+import numpy as np
+from embedding_store import EmbeddingStore, read_overrides, write_overrides
+from index_release import load_release, publish_release, replace_file
+from search_3 import (INDEX_PATH, MAPPING_PATH, METADATA_PATH,
+                      SEGMENT_INDEX_PATH, SEGMENT_MAPPING_PATH, SEGMENT_METADATA_PATH)
+
+def _with_explicit_ids(index):
+    # IVF indexes keep their own ids; Flat and HNSW need an IDMap2 wrapper
+    if isinstance(index, (faiss.IndexIDMap2, faiss.IndexIVF)):
+        return index
+
+    # Indexes built before ids were explicit: re-add the same vectors under their positions
+    vectors = index.reconstruct_n(0, index.ntotal)
+    base = faiss.clone_index(index)
+    base.reset()
+
+    id_map = faiss.IndexIDMap2(base)
+    id_map.add_with_ids(vectors, np.arange(len(vectors), dtype=np.int64))
+    return id_map
+
+class IndexMaintainer:
+    # Edits the live index. save() publishes the index, mapping, metadata and metadata store as
+    # one new release, and applies the same edits to the catalog (the output7 EmbeddingStore and
+    # metadata CSV next to metadata_path). Edited ids are recorded as overrides there, which
+    # inference_2 and inference_3 skip, so later pipeline runs and builds keep the edits.
+    def __init__(self, index_path=INDEX_PATH, mapping_path=MAPPING_PATH, metadata_path=METADATA_PATH,
+                 store_name='embeddings'):
+        self.index_path = index_path
+        self.mapping_path = mapping_path
+        self.metadata_path = metadata_path
+        self.store_name = store_name
+        self.release = load_release(index_path, mapping_path, metadata_path)
+
+        self.index = _with_explicit_ids(faiss.read_index(self.release.index_path))
+
+        with open(self.release.mapping_path, 'r', encoding='utf-8') as f:
+            mappings = json.load(f)
+        self.entries = {int(k): v for k, v in mappings['metadata'].items()}
+        self.deleted = set(mappings.get('deleted', []))
+        self.next_id = mappings.get('next_id', max(self.entries, default=-1) + 1)
+
+        self.metadata = {}
+        with open(self.release.metadata_path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                self.metadata[row['id']] = {'id': row['id'], 'song': row['song'], 'info': row['info']}
+
+        # Catalog edits not saved yet: song id -> (song, info, embeddings, offsets), None if removed
+        self.changes = {}
+
+    @classmethod
+    def for_segments(cls):
+        return cls(SEGMENT_INDEX_PATH, SEGMENT_MAPPING_PATH, SEGMENT_METADATA_PATH, 'segments')
+
+    def _vector_ids(self, song_ids):
+        song_ids = set(song_ids)
+        return [vector_id for vector_id, entry in self.entries.items()
+                if entry['id'] in song_ids and vector_id not in self.deleted]
+
+    def supports_removal(self):
+        if isinstance(self.index, faiss.IndexIVF):
+            return True
+        try:
+            self.index.index.remove_ids(faiss.IDSelectorBatch(np.empty(0, dtype=np.int64)))
+            return True
+        except RuntimeError:
+            return False
+
+    def remove_songs(self, song_ids):
+        vector_ids = self._vector_ids(song_ids)
+        if vector_ids:
+            if self.supports_removal():
+                self.index.remove_ids(faiss.IDSelectorBatch(np.array(vector_ids, dtype=np.int64)))
+                for vector_id in vector_ids:
+                    del self.entries[vector_id]
+            else:
+                # HNSW cannot delete in place: hide the vectors until compact()
+                self.deleted.update(vector_ids)
+
+        for song_id in song_ids:
+            self.metadata.pop(song_id, None)
+            self.changes[song_id] = None
+        return len(vector_ids)
+
+    def add_songs(self, songs):
+        # songs: iterable of (song_id, song, info, embeddings[n, d], offsets[n] or None).
+        # Existing ids are replaced, which makes this the update path as well.
+        songs = list(songs)
+        self.remove_songs([song[0] for song in songs])
+
+        vectors, vector_ids = [], []
+        for song_id, song, info, embeddings, offsets in songs:
+            embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.index.d)
+            for row, embedding in enumerate(embeddings):
+                entry = {'id': song_id}
+                if offsets is not None:
+                    entry['offset'] = round(float(offsets[row]), 3)
+                self.entries[self.next_id] = entry
+                vector_ids.append(self.next_id)
+                self.next_id += 1
+            vectors.append(embeddings)
+            self.metadata[song_id] = {'id': song_id, 'song': song, 'info': info}
+            self.changes[song_id] = (song, info, embeddings, offsets)
+
+        if vectors:
+            self.index.add_with_ids(np.ascontiguousarray(np.vstack(vectors)),
+                                    np.array(vector_ids, dtype=np.int64))
+        return len(vector_ids)
+
+    def compact(self):
+        if not self.deleted:
+            return 0
+
+        live_ids = np.array(sorted(set(self.entries) - self.deleted), dtype=np.int64)
+        vectors = np.vstack([self.index.reconstruct(int(i)) for i in live_ids]) if len(live_ids) else None
+
+        base = faiss.clone_index(self.index.index)
+        base.reset()
+        index = faiss.IndexIDMap2(base)
+        if vectors is not None:
+            index.add_with_ids(vectors, live_ids)
+
+        removed = len(self.deleted)
+        for vector_id in self.deleted:
+            self.entries.pop(vector_id, None)
+        self.deleted = set()
+        self.index = index
+        return removed
+
+    def update_catalog(self):
+        if not self.changes:
+            return
+
+        folder = os.path.dirname(self.metadata_path)
+        # Overrides go first: once they are written, a pipeline rerun cannot undo the edits below
+        removed, updated = read_overrides(folder, self.store_name)
+        for song_id, change in self.changes.items():
+            if change is None:
+                removed.add(song_id)
+                updated.discard(song_id)
+            else:
+                updated.add(song_id)
+                removed.discard(song_id)
+        write_overrides(folder, self.store_name, removed, updated)
+
+        if EmbeddingStore.exists(folder, self.store_name):
+            store = EmbeddingStore(folder, self.store_name)
+            store.remove([entry['song'] for entry in store.entries if entry['id'] in self.changes])
+            store.append([(song_id,) + change for song_id, change in self.changes.items() if change is not None])
+        else:
+            print(f"Warning: no embedding store in {folder}, a full index rebuild will not include added songs")
+
+        if os.path.exists(self.metadata_path):
+            with open(self.metadata_path, newline='', encoding='utf-8') as f:
+                rows = [row for row in csv.DictReader(f) if row['id'] not in self.changes]
+            rows.extend({'id': song_id, 'song': change[0], 'info': change[1]}
+                        for song_id, change in self.changes.items() if change is not None)
+
+            def write_metadata(path):
+                with open(path, 'w', newline='', encoding='utf-8') as f:
+                    writer = csv.DictWriter(f, fieldnames=['id', 'song', 'info'])
+                    writer.writeheader()
+                    writer.writerows(rows)
+            replace_file(self.metadata_path, write_metadata)
+        self.changes = {}
+
+    def save(self):
+        # The catalog goes first: an edit there that never reached a release is picked up by the
+        # next full build, while a release ahead of its catalog would be undone by it
+        self.update_catalog()
+
+        def write(release):
+            faiss.write_index(self.index, release.index_path)
+            with open(release.mapping_path, 'w', encoding='utf-8') as f:
+                json.dump({'metadata': {str(k): v for k, v in sorted(self.entries.items())},
+                           'next_id': self.next_id,
+                           'deleted': sorted(self.deleted)}, f)
+            with open(release.metadata_path, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.DictWriter(f, fieldnames=['id', 'song', 'info'])
+                writer.writeheader()
+                writer.writerows(self.metadata.values())
+
+        self.release = publish_release(self.index_path, write)
+
+def embed_audio_file(generator, audio_path, segment_mode=False, segment_hop=None):
+    from process_audio_1 import load_audio
+    from process_audio_3 import audio_to_mel
+
+    audio, sr = load_audio(audio_path)
+    mel_spec = audio_to_mel(audio, sr)
+    if mel_spec is None:
+        raise ValueError(f"{audio_path} is too short after trimming silence")
+
+    if segment_mode:
+        segments, offsets = generator.segment(mel_spec, segment_hop)
+        return generator.generate_embeddings(segments), offsets
+    return generator.generate_embedding(generator.preprocess(mel_spec)), None
+
+def main():
+    parser = argparse.ArgumentParser(description="Add, update or remove songs in the live index")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    add_parser = subparsers.add_parser("add", help="Add or replace a song from an audio file")
+    add_parser.add_argument("audio_path")
+    add_parser.add_argument("--id", required=True)
+    add_parser.add_argument("--info", required=True, help="'title||artist'")
+    # Unset options are taken from the catalog the index was built from (see inference_2)
+    add_parser.add_argument("--model")
+    add_parser.add_argument("--backend", help="torch, torchscript or onnx")
+    add_parser.add_argument("--input-mode", help="resize, crop or native")
+    add_parser.add_argument("--segment-hop", type=int)
+
+    remove_parser = subparsers.add_parser("remove", help="Remove songs by id")
+    remove_parser.add_argument("ids", nargs="+")
+
+    subparsers.add_parser("compact", help="Drop tombstoned vectors from the index")
+
+    for sub in subparsers.choices.values():
+        sub.add_argument("--segments", action="store_true", help="Maintain the segment index")
+    args = parser.parse_args()
+
+    maintainer = IndexMaintainer.for_segments() if args.segments else IndexMaintainer()
+
+    if args.command == "add":
+        from inference_2 import EmbeddingGenerator, read_generator_options
+        options = read_generator_options(os.path.dirname(maintainer.metadata_path), maintainer.store_name)
+        if not options:
+            print("Warning: the catalog does not record how it was embedded, using the default model and options")
+        model_path = args.model or options.get('model_path') or os.path.join("checkpoints", "resnetface_best.pth")
+        generator = EmbeddingGenerator(model_path, backend=args.backend or options.get('backend', 'torch'),
+                                       input_mode=args.input_mode or options.get('input_mode', 'resize'))
+        segment_hop = args.segment_hop or options.get('segment_hop')
+        embeddings, offsets = embed_audio_file(generator, args.audio_path, args.segments, segment_hop)
+        # Named like the catalog's own entries (see inference_2.process_inference_data)
+        song = os.path.splitext(os.path.basename(args.audio_path))[0] + ("_segments" if args.segments else "_embedding")
+        count = maintainer.add_songs([(args.id, song, args.info, embeddings, offsets)])
+        print(f"Added {count} vectors for song {args.id}")
+    elif args.command == "remove":
+        count = maintainer.remove_songs(args.ids)
+        print(f"Removed {count} vectors")
+    else:
+        count = maintainer.compact()
+        print(f"Compacted {count} tombstoned vectors")
+
+    maintainer.save()
+    print(f"Index release {maintainer.release.name} published: {os.path.dirname(maintainer.release.index_path)}")
+
+if __name__ == "__main__":
+    main()
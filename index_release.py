@@ -0,0 +1,107 @@
+import os
+import json
+import shutil
+from metadata_store import build_metadata_store, store_folder
+
+# A release is one folder holding everything a search reads, published as a unit:
+#   index.faiss, mapping.json, metadata.csv and store/ (the MetadataStore)
+# <index>.current names the live release and is swapped with os.replace, so a reader sees
+# the previous release or the next one, never a mix. Published releases are never modified.
+INDEX_FILE = "index.faiss"
+MAPPING_FILE = "mapping.json"
+METADATA_FILE = "metadata.csv"
+STORE_FOLDER = "store"
+# Older releases are kept a while for readers that have just resolved the pointer
+KEEP_RELEASES = 3
+
+def replace_file(path, write):
+    # Write to a sibling temp file, fsync, then atomically swap it in
+    tmp_path = f"{path}.tmp"
+    write(tmp_path)
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def releases_folder(index_path):
+    return f"{os.path.splitext(index_path)[0]}_releases"
+
+def pointer_path(index_path):
+    return f"{os.path.splitext(index_path)[0]}.current"
+
+class Release:
+    def __init__(self, name, index_path, mapping_path, metadata_path, store_folder):
+        self.name = name
+        self.index_path = index_path
+        self.mapping_path = mapping_path
+        self.metadata_path = metadata_path
+        self.store_folder = store_folder
+
+    @classmethod
+    def in_folder(cls, folder, name):
+        return cls(name, os.path.join(folder, INDEX_FILE), os.path.join(folder, MAPPING_FILE),
+                   os.path.join(folder, METADATA_FILE), os.path.join(folder, STORE_FOLDER))
+
+def current_release_name(index_path):
+    try:
+        with open(pointer_path(index_path), 'r', encoding='utf-8') as f:
+            return json.load(f)['release']
+    except FileNotFoundError:
+        return None
+
+def load_release(index_path, mapping_path, metadata_path):
+    # The published release, or the flat files of an index built before releases existed
+    name = current_release_name(index_path)
+    if name is None:
+        return Release(None, index_path, mapping_path, metadata_path, store_folder(mapping_path))
+    return Release.in_folder(os.path.join(releases_folder(index_path), name), name)
+
+def release_version(index_path, mapping_path, metadata_path):
+    # Changes exactly when a new release is published; flat files fall back to their stats
+    name = current_release_name(index_path)
+    if name is not None:
+        return name
+    return tuple((stat.st_size, stat.st_mtime_ns) for stat in map(os.stat, (index_path, mapping_path, metadata_path)))
+
+def _fsync_folder(folder):
+    for root, _, files in os.walk(folder):
+        for name in files:
+            with open(os.path.join(root, name), 'rb') as f:
+                os.fsync(f.fileno())
+        if hasattr(os, 'O_DIRECTORY'):
+            fd = os.open(root, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+def _prune(root, current):
+    # Only releases older than the ones kept; newer folders may be another writer's in progress
+    numbers = sorted(int(name) for name in os.listdir(root) if name.isdigit() and int(name) <= current)
+    for number in numbers[:-KEEP_RELEASES]:
+        shutil.rmtree(os.path.join(root, f"{number:08d}"), ignore_errors=True)
+
+def publish_release(index_path, write):
+    # write(release) fills a fresh release folder with the index, mapping and metadata;
+    # the metadata store is built here, then the pointer switches to the new release
+    root = releases_folder(index_path)
+    os.makedirs(root, exist_ok=True)
+    number = max((int(name) for name in os.listdir(root) if name.isdigit()), default=0) + 1
+    while True:
+        try:
+            os.makedirs(os.path.join(root, f"{number:08d}"))
+            break
+        except FileExistsError:
+            number += 1
+
+    name = f"{number:08d}"
+    release = Release.in_folder(os.path.join(root, name), name)
+    write(release)
+    build_metadata_store(release.mapping_path, release.metadata_path, release.store_folder)
+    _fsync_folder(os.path.join(root, name))
+
+    def write_pointer(path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'release': name}, f)
+    replace_file(pointer_path(index_path), write_pointer)
+    _prune(root, number)
+    return release
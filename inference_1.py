@@ -1,16 +1,30 @@
 import os
 import csv
-from tqdm import tqdm
-from concurrent.futures import ProcessPoolExecutor
+from parallel import run_parallel
+from artifact_cache import ArtifactManifest
 from process_audio_1 import process_file
 
+PREPROCESS_PARAMS = {'stage': 'preprocess', 'min_dur': 0.5, 'max_dur': None, 'format': 'mp3'}
+
+def write_metadata(output_folder, output_metadata):
+    output_metadata_file = os.path.join(output_folder, "metadata.csv")
+    with open(output_metadata_file, "w", newline="", encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["id", "song", "info"])
+        writer.writerows(output_metadata)
+
 def process_inference_step1(data_folder, output_folder, target_db=-20.0, num_workers=8):
     output_folder = os.path.join(output_folder, "output4")
     os.makedirs(output_folder, exist_ok=True)
     metadata_path = os.path.join(data_folder, "metadata.csv")
     output_metadata = []
+    failed = set()
     processing_args = []
 
+    # Outputs are reused only while the source audio and these parameters are unchanged
+    manifest = ArtifactManifest(os.path.join(output_folder, "manifest.jsonl"),
+                                dict(PREPROCESS_PARAMS, target_db=target_db))
+
     fieldnames = ['id', 'song', 'info']
 
     with open(metadata_path, newline='', encoding='utf-8') as csvfile:
@@ -21,35 +35,29 @@ def process_inference_step1(data_folder, output_folder, target_db=-20.0, num_wor
             song_input = os.path.join(data_folder, "song", row['song'])
             song_output = os.path.join(output_folder, "song", song_file)
 
-            # Skip if output file already exists
-            if os.path.exists(song_output):
-                output_metadata.append([row['id'],
-                                     os.path.basename(song_output),
-                                     row['info']])
+            output_metadata.append([row['id'], song_file, row['info']])
+            if manifest.is_current(song_file, song_input, song_output):
                 continue
 
             os.makedirs(os.path.dirname(song_output), exist_ok=True)
-            processing_args.append(((song_input, song_output, 0.5, None, target_db), row))
+            processing_args.append(((song_input, song_output, PREPROCESS_PARAMS['min_dur'],
+                                     PREPROCESS_PARAMS['max_dur'], target_db), row))
 
     if processing_args:
-        with ProcessPoolExecutor(max_workers=num_workers) as executor:
-            for (args, row) in tqdm(processing_args, desc="Processing Files"):
-                future = executor.submit(process_file, args)
-                if future.result():
-                    output_metadata.append([row['id'],
-                                         os.path.basename(args[1]),
-                                         row['info']])
+        for (args,), success in run_parallel(process_file, [(args,) for args, _ in processing_args],
+                                             num_workers=num_workers, desc="Processing Files"):
+            if success:
+                manifest.record(os.path.basename(args[1]), args[0])
+            else:
+                failed.add(os.path.basename(args[1]))
     else:
         print("No new files to process in step 1")
 
-    output_metadata_file = os.path.join(output_folder, "metadata.csv")
-    with open(output_metadata_file, "w", newline="", encoding='utf-8') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(["id", "song", "info"])
-        writer.writerows(output_metadata)
+    manifest.close()
+    write_metadata(output_folder, [row for row in output_metadata if row[1] not in failed])
 
-def process_inference_step3(input_folder, output_folder):
-    from process_audio_3 import process_file as process_mel_file
+def process_inference_step3(input_folder, output_folder, num_workers=8, resample_quality='high'):
+    from process_audio_3 import process_file as process_mel_file, MEL_PARAMS
 
     input_folder = os.path.join(input_folder, "output4")
     output_folder = os.path.join(output_folder, "output6")
@@ -57,45 +65,107 @@ def process_inference_step3(input_folder, output_folder):
 
     metadata_path = os.path.join(input_folder, "metadata.csv")
     output_metadata = []
+    failed = set()
     files_to_process = []
 
+    # The mp3 content hash chains this stage to step 1's parameters
+    manifest = ArtifactManifest(os.path.join(output_folder, "manifest.jsonl"),
+                                dict(MEL_PARAMS, stage='mel', resample_quality=resample_quality))
+
     with open(metadata_path, newline='', encoding='utf-8') as csvfile:
         reader = csv.DictReader(csvfile)
         rows = list(reader)
 
         for row in rows:
+            mel_file = f"{os.path.splitext(row['song'])[0]}.npy"
             input_path = os.path.join(input_folder, "song", row['song'])
-            output_path = os.path.join(output_folder, "song", f"{os.path.splitext(row['song'])[0]}.npy")
+            output_path = os.path.join(output_folder, "song", mel_file)
 
-            # Skip if output file already exists
-            if os.path.exists(output_path):
-                output_metadata.append([row['id'],
-                                     f"{os.path.splitext(row['song'])[0]}.npy",
-                                     row['info']])
+            output_metadata.append([row['id'], mel_file, row['info']])
+            if manifest.is_current(mel_file, input_path, output_path):
                 continue
 
             files_to_process.append((row, input_path, output_path))
 
     if files_to_process:
-        for row, input_path, output_path in tqdm(files_to_process, desc="Processing Audio Files"):
-            if process_mel_file(input_path, output_path):
-                output_metadata.append([row['id'],
-                                     f"{os.path.splitext(row['song'])[0]}.npy",
-                                     row['info']])
+        # The full MEL_PARAMS goes to the workers, matching what the manifest fingerprints
+        tasks = [(input_path, output_path, MEL_PARAMS, resample_quality)
+                 for _, input_path, output_path in files_to_process]
+        for task, success in run_parallel(process_mel_file, tasks, num_workers=num_workers,
+                                          key=lambda task: task[:2], desc="Processing Audio Files"):
+            if success:
+                manifest.record(os.path.basename(task[1]), task[0])
+            else:
+                failed.add(os.path.basename(task[1]))
     else:
         print("No new files to process in step 3")
 
-    output_metadata_file = os.path.join(output_folder, "metadata.csv")
-    with open(output_metadata_file, "w", newline="", encoding='utf-8') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(["id", "song", "info"])
-        writer.writerows(output_metadata)
+    manifest.close()
+    write_metadata(output_folder, [row for row in output_metadata if row[1] not in failed])
+
+def process_inference_fused(data_folder, output_folder, target_db=-20.0, num_workers=8, keep_pcm=False,
+                            resample_quality='high'):
+    # Steps 1 and 3 in one pass per file: output6 mels straight from the source audio.
+    # keep_pcm stores the prepared audio in output4 as lossless WAV instead of mp3.
+    from process_audio_3 import process_file_fused, MEL_PARAMS
+
+    mel_folder = os.path.join(output_folder, "output6")
+    pcm_folder = os.path.join(output_folder, "output4")
+    os.makedirs(os.path.join(mel_folder, "song"), exist_ok=True)
+    metadata_path = os.path.join(data_folder, "metadata.csv")
+    output_metadata = []
+    failed = set()
+    files_to_process = []
+
+    params = dict(PREPROCESS_PARAMS, **MEL_PARAMS, stage='fused', target_db=target_db, format=None,
+                  resample_quality=resample_quality)
+    manifest = ArtifactManifest(os.path.join(mel_folder, "manifest.jsonl"), params)
+
+    fieldnames = ['id', 'song', 'info']
+
+    with open(metadata_path, newline='', encoding='utf-8') as csvfile:
+        reader = csv.DictReader(csvfile, fieldnames=fieldnames)
+        next(reader)
+        for row in reader:
+            name = os.path.splitext(row['song'])[0]
+            song_input = os.path.join(data_folder, "song", row['song'])
+            mel_output = os.path.join(mel_folder, "song", f"{name}.npy")
+            pcm_output = os.path.join(pcm_folder, "song", f"{name}.wav") if keep_pcm else None
+
+            output_metadata.append([row['id'], f"{name}.npy", row['info']])
+            if manifest.is_current(f"{name}.npy", song_input, mel_output) and \
+                    (pcm_output is None or os.path.exists(pcm_output)):
+                continue
+
+            files_to_process.append((row, (song_input, mel_output, PREPROCESS_PARAMS['min_dur'],
+                                           PREPROCESS_PARAMS['max_dur'], target_db, pcm_output,
+                                           MEL_PARAMS, resample_quality)))
+
+    if files_to_process:
+        tasks = [task for _, task in files_to_process]
+        for task, success in run_parallel(process_file_fused, tasks, num_workers=num_workers,
+                                          key=lambda task: task[:2], desc="Processing Files"):
+            if success:
+                manifest.record(os.path.basename(task[1]), task[0])
+            else:
+                failed.add(os.path.basename(task[1]))
+    else:
+        print("No new files to process")
+
+    manifest.close()
+    write_metadata(mel_folder, [row for row in output_metadata if row[1] not in failed])
+
+def process_inference_data(data_folder, output_folder, fused=False, resample_quality='high'):
+    if fused:
+        print("Running fused preprocessing and mel extraction...")
+        process_inference_fused(data_folder, output_folder, resample_quality=resample_quality)
+        print("Inference preprocessing complete.")
+        return
 
-def process_inference_data(data_folder, output_folder):
     print("Running step 1: Audio preprocessing...")
     process_inference_step1(data_folder, output_folder)
 
     print("Running step 2: Converting to mel spectrograms...")
-    process_inference_step3(output_folder, output_folder)
+    process_inference_step3(output_folder, output_folder, resample_quality=resample_quality)
 
     print("Inference preprocessing complete.")
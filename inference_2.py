@@ -2,21 +2,98 @@ import torch
 import numpy as np
 import os
 import csv
+import json
 from torch.nn import DataParallel
-from train_model_3 import ResNetFace
+from train_model_3 import ResNetFace, fit_input
+from inference_optimize import optimize_for_inference
 from train_model_2 import Config
+from embedding_store import EmbeddingStore, read_overrides
+from artifact_cache import ArtifactManifest, array_hash
+from spectrogram_store import SpectrogramShardReader
 from tqdm import tqdm
 import torch.nn.functional as F
 
+MEL_FRAME_SECONDS = 256 / 22050
+BACKENDS = ('torch', 'torchscript', 'onnx')
+# How a mel becomes model input: bilinear resize to the input width, the training crop/pad,
+# or the mel as is (AdaptiveAvgPool2d takes any width)
+INPUT_MODES = ('resize', 'crop', 'native')
+
+def preprocess_mel(mel_spec, input_shape):
+    # Bilinear resize of a (n_mels, frames) mel to the model input, as a (1, 1, H, W) tensor
+    mel_spec = torch.from_numpy(mel_spec).float()
+    mel_spec = mel_spec.unsqueeze(0).unsqueeze(0)
+    return F.interpolate(mel_spec, size=(input_shape[1], input_shape[2]), mode='bilinear', align_corners=False)
+
+def export_info(model_path):
+    # Sidecar written by export_model.py next to an exported model
+    info_path = f"{model_path}.json"
+    if not os.path.exists(info_path):
+        return {}
+    with open(info_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+class OnnxModel:
+    # onnxruntime session called like the torch model: float tensor in, float tensor out
+    def __init__(self, model_path):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("The onnx backend requires onnxruntime (pip install onnxruntime)")
+        self.session = ort.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, x):
+        x = x.detach().cpu().numpy().astype(np.float32, copy=False)
+        return torch.from_numpy(self.session.run(None, {self.input_name: x})[0])
+
+def load_exported_model(model_path, backend):
+    if backend == 'torchscript':
+        # Quantized kernels must run on the engine they were converted for
+        engine = export_info(model_path).get('engine')
+        if engine:
+            torch.backends.quantized.engine = engine
+        model = torch.jit.load(model_path, map_location='cpu')
+        model.eval()
+        return model
+    if backend == 'onnx':
+        return OnnxModel(model_path)
+    raise ValueError(f"Unknown backend: {backend}, expected one of {list(BACKENDS)}")
+
 class EmbeddingGenerator:
-    def __init__(self, model_path, device=None):
+    # backend='torch' loads a training checkpoint; 'torchscript' and 'onnx' load a model
+    # written by export_model.py and always run on the CPU.
+    # optimize=True folds BatchNorms and runs channels_last (torch backend only), see inference_optimize.py.
+    # input_mode='native' pads each mel only up to a multiple of bucket_frames, cropping at max_frames.
+    def __init__(self, model_path, device=None, backend='torch', optimize=False, bf16=False, compile_model=False,
+                 input_mode='resize', bucket_frames=32, max_frames=None):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend: {backend}, expected one of {list(BACKENDS)}")
+        if input_mode not in INPUT_MODES:
+            raise ValueError(f"Unknown input mode: {input_mode}, expected one of {list(INPUT_MODES)}")
+        if input_mode == 'native' and backend == 'onnx':
+            raise ValueError("ONNX models are exported for a fixed input width, use input_mode 'resize' or 'crop'")
         self.config = Config()
         self.embedding_dim = self.config.embedding_dim
+        self.backend = backend
+        self.input_mode = input_mode
+        self.bucket_frames = bucket_frames
+        self.max_frames = max_frames
+        if backend != 'torch':
+            device = torch.device("cpu")
         self.device = device if device else torch.device("cuda" if torch.cuda.is_available() else "cpu")
         print(f"Using device: {self.device}")
+        print(f"Backend: {self.backend}")
+        print(f"Input mode: {self.input_mode}")
         print(f"Input shape: {self.config.input_shape}")
         print(f"Embedding dimension: {self.embedding_dim}")
-        self.model = self._initialize_model(model_path)
+        if backend == 'torch':
+            self.model = self._initialize_model(model_path)
+            if optimize:
+                self.model = optimize_for_inference(self.model, bf16=bf16, compile_model=compile_model)
+                print(f"Optimized for inference (bf16: {self.model.bf16}, compiled: {compile_model})")
+        else:
+            self.model = load_exported_model(model_path, backend)
 
     def _initialize_model(self, model_path):
         model = ResNetFace(feature_dim=self.embedding_dim)
@@ -43,23 +120,16 @@ class EmbeddingGenerator:
         return model
 
     def load_and_preprocess(self, npy_path):
-        mel_spec = np.load(npy_path)
-        mel_spec = torch.from_numpy(mel_spec).float()
-        mel_spec = mel_spec.unsqueeze(0).unsqueeze(0)
-
-        target_shape = (
-            self.config.input_shape[1],
-            self.config.input_shape[2]
-        )
-
-        mel_spec = F.interpolate(
-            mel_spec,
-            size=target_shape,
-            mode='bilinear',
-            align_corners=False
-        )
+        return self.preprocess(np.load(npy_path))
 
-        return mel_spec
+    def preprocess(self, mel_spec):
+        if self.input_mode == 'resize':
+            return preprocess_mel(mel_spec, self.config.input_shape)
+        if self.input_mode == 'crop':
+            mel_spec = fit_input(mel_spec, self.config.input_shape[1:])
+        elif self.max_frames:
+            mel_spec = mel_spec[:, :self.max_frames]
+        return torch.from_numpy(np.ascontiguousarray(mel_spec, dtype=np.float32)).unsqueeze(0).unsqueeze(0)
 
     def generate_embedding(self, input_tensor):
         with torch.no_grad():
@@ -71,19 +141,123 @@ class EmbeddingGenerator:
 
             return embedding.cpu().numpy()
 
-def process_inference_data(input_folder, output_folder, model_path):
+    def segment(self, mel_spec, hop=None):
+        # Overlapping input-width windows over the native mel, zero-padding the last one
+        window = self.config.input_shape[2]
+        hop = hop or window // 2
+        mel_spec = torch.from_numpy(np.ascontiguousarray(mel_spec)).float()
+
+        num_frames = mel_spec.shape[1]
+        num_segments = 1 + max(0, -(-(num_frames - window) // hop))
+        padded_frames = (num_segments - 1) * hop + window
+        if padded_frames > num_frames:
+            mel_spec = F.pad(mel_spec, (0, padded_frames - num_frames))
+
+        segments = mel_spec.unfold(1, window, hop).permute(1, 0, 2).unsqueeze(1)
+        offsets = np.arange(num_segments, dtype=np.float32) * hop * MEL_FRAME_SECONDS
+        return segments, offsets
+
+    def _iter_batches(self, tensors, batch_size):
+        pending = []
+        pending_rows = 0
+        for tensor in tensors:
+            start = 0
+            while start < tensor.shape[0]:
+                take = min(batch_size - pending_rows, tensor.shape[0] - start)
+                pending.append(tensor[start:start + take])
+                pending_rows += take
+                start += take
+                if pending_rows == batch_size:
+                    yield torch.cat(pending, dim=0)
+                    pending = []
+                    pending_rows = 0
+        if pending:
+            yield torch.cat(pending, dim=0)
+
+    def _bucket_width(self, width):
+        if self.input_mode != 'native':
+            return width
+        return -(-width // self.bucket_frames) * self.bucket_frames
+
+    def generate_embeddings(self, inputs, batch_size=None):
+        batch_size = batch_size or self.config.train_batch_size
+
+        if isinstance(inputs, torch.Tensor):
+            inputs = [inputs]
+        tensors = [t.unsqueeze(0) if t.dim() == 3 else t for t in inputs]
+
+        # Rows are grouped by (padded) width so each batch is one tensor; output keeps input order
+        buckets = {}
+        num_rows = 0
+        for tensor in tensors:
+            width = self._bucket_width(tensor.shape[-1])
+            if width > tensor.shape[-1]:
+                tensor = F.pad(tensor, (0, width - tensor.shape[-1]))
+            group, rows = buckets.setdefault(width, ([], []))
+            group.append(tensor)
+            rows.append(np.arange(num_rows, num_rows + tensor.shape[0]))
+            num_rows += tensor.shape[0]
+
+        embeddings = np.empty((num_rows, self.embedding_dim), dtype=np.float32)
+        with torch.no_grad():
+            for width, (group, rows) in buckets.items():
+                rows = np.concatenate(rows)
+                # Same frame budget per batch whatever the width
+                bucket_batch_size = max(1, batch_size * self.config.input_shape[2] // width)
+                start = 0
+                for chunk in self._iter_batches(group, bucket_batch_size):
+                    embedding = self.model(chunk.to(self.device))
+
+                    if embedding.shape[1] != self.embedding_dim:
+                        raise ValueError(f"Invalid embedding dimension: {embedding.shape[1]}, expected {self.embedding_dim}")
+
+                    embeddings[rows[start:start + chunk.shape[0]]] = embedding.cpu().numpy()
+                    start += chunk.shape[0]
+
+        return embeddings
+
+def generator_options_path(folder, store_name):
+    return os.path.join(folder, f"{store_name}_generator.json")
+
+def read_generator_options(folder, store_name):
+    # How the store's embeddings were made, for index_maintenance to embed new songs the same way
+    path = generator_options_path(folder, store_name)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def process_inference_data(input_folder, output_folder, model_path, batch_size=None,
+                           segment_mode=False, segment_hop=None, embedding_dtype=None,
+                           shard_dir=None, backend='torch', input_mode='resize'):
     input_folder = os.path.join(input_folder, "output6")
+    shards = SpectrogramShardReader(shard_dir) if shard_dir else None
     output_folder = os.path.join(output_folder, "output7")
-    os.makedirs(os.path.join(output_folder, "song"), exist_ok=True)
+    # Segment mode stores many windows per song next to the whole-song embeddings
+    store_name = "segments" if segment_mode else "embeddings"
+    embedding_suffix = "_segments" if segment_mode else "_embedding"
+    store = EmbeddingStore(output_folder, store_name, dtype=embedding_dtype)
+    # Songs removed or replaced through index_maintenance are not taken from the catalog again
+    removed, updated = read_overrides(output_folder, store_name)
 
     metadata_path = os.path.join(input_folder, "metadata.csv")
     if not os.path.exists(metadata_path):
         print(f"Error: Metadata file not found at {metadata_path}")
         return
 
+    # Stored embeddings are reused only while the mel, these parameters and the checkpoint are unchanged
+    params = {'stage': store_name, 'segment_hop': segment_hop if segment_mode else None, 'dtype': store.dtype.name}
+    if input_mode != 'resize':
+        # Left out for 'resize' so stores built before input modes existed stay current
+        params['input_mode'] = input_mode
+    manifest = ArtifactManifest(os.path.join(output_folder, f"{store_name}_manifest.jsonl"), params,
+                                model_path=model_path)
+
     output_metadata = []
     failed_files = []
     files_to_process = []
+    catalog_songs = set()
+    stale = []
 
     print("Reading metadata and checking files...")
     with open(metadata_path, newline='', encoding='utf-8') as csvfile:
@@ -91,64 +265,138 @@ def process_inference_data(input_folder, output_folder, model_path):
         rows = list(reader)
 
         for row in rows:
+            if row['id'] in removed or row['id'] in updated:
+                continue
             input_path = os.path.join(input_folder, "song", row['song'])
-            output_filename = os.path.splitext(row['song'])[0] + "_embedding.npy"
-            output_path = os.path.join(output_folder, "song", output_filename)
+            output_filename = os.path.splitext(row['song'])[0] + embedding_suffix
+            if shards is not None:
+                input_path = f"song/{row['song']}"
+                found = input_path in shards
+            else:
+                found = os.path.exists(input_path)
 
-            # Skip if output file already exists
-            if os.path.exists(output_path):
+            input_hash = None
+            if found:
+                input_hash = array_hash(shards.get(input_path)) if shards is not None else manifest.input_hash(input_path)
+
+            # Reuse a stored embedding only while the mel, these parameters and the checkpoint are
+            # unchanged; anything else stored for this song is stale and dropped below
+            catalog_songs.add(output_filename)
+            if found and output_filename in store and manifest.is_current(output_filename, input_path,
+                                                                          input_hash=input_hash):
                 output_metadata.append({
                     'id': row['id'],
                     'song': output_filename,
                     'info': row['info']
                 })
                 continue
+            if output_filename in store:
+                stale.append(output_filename)
 
-            if not os.path.exists(input_path):
-                print(f"Warning: Input file not found: {input_path}")
+            if not found:
+                if shards is not None:
+                    print(f"Warning: Spectrogram not found in shards: {input_path}")
+                else:
+                    print(f"Warning: Input file not found: {input_path}")
                 failed_files.append(row)
                 continue
 
-            files_to_process.append((row, input_path, output_path))
+            files_to_process.append((row, input_path, output_filename, input_hash))
+
+    # Also catches a removal whose store edit never landed (a crash right after the overrides were written)
+    stale.extend(entry['song'] for entry in store.entries if entry['id'] in removed)
+
+    if len(store) and not output_metadata:
+        # Nothing stored is current (e.g. a new checkpoint): reclaim the space before re-embedding.
+        # Songs added through index_maintenance were embedded by the old model too and go as well.
+        print("Stored embeddings are stale, rebuilding the store")
+        store.reset()
+        if updated:
+            print(f"Warning: songs added or updated through index_maintenance must be added again: {sorted(updated)}")
+    elif stale:
+        # Removed up front, so a song whose mel is gone or fails to re-embed cannot keep an
+        # embedding from another checkpoint or parameter set
+        print(f"Dropping {store.remove(stale)} stale stored embeddings")
 
     if files_to_process:
-        generator = EmbeddingGenerator(model_path)
-        batch_size = generator.config.train_batch_size
+        generator = EmbeddingGenerator(model_path, backend=backend, input_mode=input_mode)
+        batch_size = batch_size or generator.config.train_batch_size
         print(f"Using batch size: {batch_size}")
 
         for i in tqdm(range(0, len(files_to_process), batch_size), desc="Processing batches"):
             batch = files_to_process[i:i + batch_size]
 
-            for row, input_path, output_path in batch:
+            batch_tensors = []
+            batch_items = []
+            for row, input_path, output_filename, input_hash in batch:
                 try:
-                    input_tensor = generator.load_and_preprocess(input_path)
-                    embedding = generator.generate_embedding(input_tensor)
-                    np.save(output_path, embedding)
-
-                    output_metadata.append({
-                        'id': row['id'],
-                        'song': os.path.basename(output_path),
-                        'info': row['info']
-                    })
-
-                except ValueError as ve:
-                    print(f"Error with embedding generation for {row['song']}: {ve}")
-                    failed_files.append(row)
+                    if shards is not None:
+                        mel_spec = np.ascontiguousarray(shards.get(input_path), dtype=np.float32)
+                    else:
+                        mel_spec = np.load(input_path)
+
+                    if segment_mode:
+                        tensor, offsets = generator.segment(mel_spec, segment_hop)
+                    else:
+                        tensor, offsets = generator.preprocess(mel_spec), None
+                    batch_tensors.append(tensor)
+                    batch_items.append((row, input_path, output_filename, input_hash, offsets))
                 except Exception as e:
                     print(f"Error processing file {row['song']}: {str(e)}")
                     failed_files.append(row)
+
+            if not batch_tensors:
+                continue
+
+            try:
+                embeddings = generator.generate_embeddings(batch_tensors, batch_size)
+                bounds = np.cumsum([tensor.shape[0] for tensor in batch_tensors])[:-1]
+                results = list(zip(batch_items, np.split(embeddings, bounds)))
+            except Exception as e:
+                # One bad input fails the whole forward pass: retry one by one so only it fails
+                print(f"Error with batch embedding generation, retrying files one by one: {str(e)}")
+                results = []
+                for item, tensor in zip(batch_items, batch_tensors):
+                    try:
+                        results.append((item, generator.generate_embeddings([tensor], batch_size)))
+                    except Exception as e:
+                        print(f"Error with embedding generation for {item[0]['song']}: {str(e)}")
+                        failed_files.append(item[0])
+
+            store_items = []
+            for (row, _, output_filename, _, offsets), song_embeddings in results:
+                store_items.append((row['id'], output_filename, row['info'], song_embeddings, offsets))
+
+                output_metadata.append({
+                    'id': row['id'],
+                    'song': output_filename,
+                    'info': row['info']
+                })
+
+            store.append(store_items)
+            for (_, input_path, output_filename, input_hash, _), _ in results:
+                manifest.record(output_filename, input_path, input_hash=input_hash)
+
     else:
         print("No new files to process")
 
-    output_metadata_path = os.path.join(output_folder, "metadata.csv")
+    manifest.close()
+    with open(generator_options_path(output_folder, store_name), 'w', encoding='utf-8') as f:
+        json.dump({'model_path': model_path, 'backend': backend, 'input_mode': input_mode,
+                   'segment_hop': segment_hop}, f)
+    # Songs added through index_maintenance are in the store but not in the catalog; keep their rows
+    added_metadata = [{'id': entry['id'], 'song': entry['song'], 'info': entry['info']}
+                      for entry in store.entries if entry['song'] not in catalog_songs]
+    metadata_name = "segment_metadata.csv" if segment_mode else "metadata.csv"
+    output_metadata_path = os.path.join(output_folder, metadata_name)
     with open(output_metadata_path, 'w', newline='', encoding='utf-8') as csvfile:
         fieldnames = ['id', 'song', 'info']
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
         writer.writeheader()
-        writer.writerows(output_metadata)
+        writer.writerows(output_metadata + added_metadata)
 
     print(f"Processing completed! Successfully processed {len(output_metadata)} files")
     if failed_files:
         print(f"Failed to process {len(failed_files)} files")
-    print(f"Embeddings saved to: {os.path.join(output_folder, 'song')}")
+    print(f"Embeddings saved to: {store.data_path} ({store.num_rows} rows)")
     print(f"Metadata saved to: {output_metadata_path}")
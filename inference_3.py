@@ -0,0 +1,232 @@
+import os
+import csv
+import json
+import time
+import shutil
+import argparse
+import faiss
+import numpy as np
+from tqdm import tqdm
+from embedding_store import EmbeddingStore, read_overrides
+from index_release import publish_release
+
+def load_song_embeddings(input_folder):
+    metadata_path = os.path.join(input_folder, "metadata.csv")
+    embeddings = []
+    entries = []
+
+    with open(metadata_path, newline='', encoding='utf-8') as csvfile:
+        for row in tqdm(list(csv.DictReader(csvfile)), desc="Loading embeddings"):
+            embedding = np.load(os.path.join(input_folder, "song", row['song']))
+            embeddings.append(embedding.reshape(1, -1))
+            entries.append({'id': row['id']})
+
+    return embeddings, entries
+
+def load_segment_embeddings(input_folder):
+    metadata_path = os.path.join(input_folder, "segment_metadata.csv")
+    embeddings = []
+    entries = []
+
+    with open(metadata_path, newline='', encoding='utf-8') as csvfile:
+        for row in tqdm(list(csv.DictReader(csvfile)), desc="Loading segment embeddings"):
+            data = np.load(os.path.join(input_folder, "segment", row['song']))
+            embeddings.append(data['embeddings'])
+            entries.extend({'id': row['id'], 'offset': round(float(offset), 3)} for offset in data['offsets'])
+
+    return embeddings, entries
+
+INDEX_TYPES = ('flat', 'ivf-flat', 'ivf-pq', 'hnsw')
+
+def create_index(index_type, dim, num_vectors, nlist=1024, nprobe=16, pq_m=64, pq_nbits=8,
+                 hnsw_m=32, ef_construction=200, ef_search=128):
+    if index_type == 'flat':
+        return faiss.IndexFlatL2(dim)
+
+    if index_type in ('ivf-flat', 'ivf-pq'):
+        # Keep roughly 39 training points per centroid, as faiss recommends
+        nlist = max(1, min(nlist, num_vectors // 39))
+        quantizer = faiss.IndexFlatL2(dim)
+        if index_type == 'ivf-flat':
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+        else:
+            if dim % pq_m:
+                raise ValueError(f"pq_m ({pq_m}) must divide the embedding dimension ({dim})")
+            # Each sub-quantizer trains 2**pq_nbits centroids, which needs at least that many vectors
+            max_nbits = num_vectors.bit_length() - 1
+            if max_nbits < 1:
+                raise ValueError(f"IVF-PQ needs at least 2 training vectors, got {num_vectors}")
+            if pq_nbits > max_nbits:
+                print(f"Only {num_vectors} vectors to train on: lowering pq_nbits from {pq_nbits} to {max_nbits}")
+                pq_nbits = max_nbits
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, pq_nbits)
+        index.nprobe = min(nprobe, nlist)
+        return index
+
+    if index_type == 'hnsw':
+        index = faiss.IndexHNSWFlat(dim, hnsw_m)
+        index.hnsw.efConstruction = ef_construction
+        index.hnsw.efSearch = ef_search
+        return index
+
+    raise ValueError(f"Unknown index type: {index_type}, expected one of {INDEX_TYPES}")
+
+def populate_index(index, embeddings):
+    if not index.is_trained:
+        index.train(embeddings)
+    index.add(embeddings)
+    return index
+
+def load_store_embeddings(input_folder, segment_mode=False):
+    store = EmbeddingStore(input_folder, "segments" if segment_mode else "embeddings")
+    row_ids = store.row_ids()
+    if segment_mode:
+        entries = [{'id': song_id, 'offset': round(float(offset), 3)}
+                   for song_id, offset in zip(row_ids, store.offsets)]
+    else:
+        entries = [{'id': song_id} for song_id in row_ids]
+    return store.as_float32(), entries
+
+def load_embeddings(input_folder, segment_mode=False):
+    store_name = "segments" if segment_mode else "embeddings"
+    if EmbeddingStore.exists(input_folder, store_name):
+        embeddings, entries = load_store_embeddings(input_folder, segment_mode)
+    else:
+        # Legacy layout with one file per song
+        if segment_mode:
+            embeddings, entries = load_segment_embeddings(input_folder)
+        else:
+            embeddings, entries = load_song_embeddings(input_folder)
+        if not entries:
+            return np.empty((0, 0), dtype=np.float32), entries
+        embeddings = np.ascontiguousarray(np.vstack(embeddings), dtype=np.float32)
+
+    # Songs removed through index_maintenance stay out even if a catalog file still has them
+    removed, _ = read_overrides(input_folder, store_name)
+    if any(entry['id'] in removed for entry in entries):
+        keep = np.array([entry['id'] not in removed for entry in entries])
+        embeddings = np.ascontiguousarray(embeddings[keep])
+        entries = [entry for entry in entries if entry['id'] not in removed]
+    return embeddings, entries
+
+def build_index(input_folder, output_folder, segment_mode=False, index_type='flat', **index_params):
+    input_folder = os.path.join(input_folder, "output7")
+    output_folder = os.path.join(output_folder, "output8")
+    os.makedirs(output_folder, exist_ok=True)
+
+    if segment_mode:
+        index_path = os.path.join(output_folder, "segment_index.faiss")
+        metadata_path = os.path.join(input_folder, "segment_metadata.csv")
+    else:
+        index_path = os.path.join(output_folder, "song_index.faiss")
+        metadata_path = os.path.join(input_folder, "metadata.csv")
+
+    embeddings, entries = load_embeddings(input_folder, segment_mode)
+    if not entries:
+        print("No embeddings found to index")
+        return None
+
+    print(f"Building {index_type} index over {len(entries)} vectors...")
+    index = create_index(index_type, embeddings.shape[1], len(entries), **index_params)
+    # Explicit ids let index_maintenance add and remove songs without renumbering.
+    # IVF indexes store ids natively; the others go through IndexIDMap2.
+    if not isinstance(index, faiss.IndexIVF):
+        index = faiss.IndexIDMap2(index)
+    if not index.is_trained:
+        index.train(embeddings)
+    index.add_with_ids(embeddings, np.arange(len(entries), dtype=np.int64))
+
+    def write(release):
+        faiss.write_index(index, release.index_path)
+        with open(release.mapping_path, 'w', encoding='utf-8') as f:
+            json.dump({'metadata': {str(i): entry for i, entry in enumerate(entries)},
+                       'next_id': len(entries)}, f)
+        if os.path.exists(metadata_path):
+            shutil.copyfile(metadata_path, release.metadata_path)
+        else:
+            with open(release.metadata_path, 'w', newline='', encoding='utf-8') as f:
+                csv.DictWriter(f, fieldnames=['id', 'song', 'info']).writeheader()
+
+    # Index, mapping, metadata and metadata store go live together
+    release = publish_release(index_path, write)
+
+    print(f"Indexed {index.ntotal} vectors from {len(set(e['id'] for e in entries))} songs")
+    print(f"Index release {release.name} published: {os.path.dirname(release.index_path)}")
+    return index
+
+def measure_index(index, queries, ground_truth, k=10):
+    index.search(queries[:1], k)
+    start = time.perf_counter()
+    _, indices = index.search(queries, k)
+    elapsed = time.perf_counter() - start
+
+    hits = sum(len(set(found) & set(truth)) for found, truth in zip(indices, ground_truth))
+    recall = hits / (len(queries) * k)
+    memory_mb = len(faiss.serialize_index(index)) / (1024 * 1024)
+    return recall, len(queries) / elapsed, memory_mb
+
+def report_indexes(input_folder, index_types=INDEX_TYPES, segment_mode=False, num_queries=1000,
+                   k=10, noise=0.05, seed=1234, **index_params):
+    embeddings, entries = load_embeddings(os.path.join(input_folder, "output7"), segment_mode)
+    if not entries:
+        print("No embeddings found to index")
+        return []
+
+    # Queries are perturbed catalog vectors; the exact flat search is the ground truth
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(embeddings), size=min(num_queries, len(embeddings)), replace=False)
+    scale = noise * np.linalg.norm(embeddings, axis=1).mean() / np.sqrt(embeddings.shape[1])
+    queries = embeddings[sample] + rng.normal(0, scale, size=(len(sample), embeddings.shape[1])).astype(np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+
+    k = min(k, len(embeddings))
+    flat = populate_index(faiss.IndexFlatL2(embeddings.shape[1]), embeddings)
+    _, ground_truth = flat.search(queries, k)
+
+    rows = []
+    for index_type in index_types:
+        start = time.perf_counter()
+        index = populate_index(create_index(index_type, embeddings.shape[1], len(embeddings), **index_params), embeddings)
+        build_seconds = time.perf_counter() - start
+
+        recall, qps, memory_mb = measure_index(index, queries, ground_truth, k)
+        rows.append({'type': index_type, 'recall': recall, 'qps': qps,
+                     'memory_mb': memory_mb, 'build_seconds': build_seconds})
+
+    print(f"\nIndex comparison over {len(embeddings)} vectors, {len(queries)} queries, k={k}")
+    print(f"{'index':<10}{f'recall@{k}':>12}{'QPS':>12}{'memory MB':>12}{'build s':>10}")
+    for row in rows:
+        print(f"{row['type']:<10}{row['recall']:>12.4f}{row['qps']:>12.1f}"
+              f"{row['memory_mb']:>12.2f}{row['build_seconds']:>10.2f}")
+
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and compare FAISS song indexes")
+    parser.add_argument("command", choices=["build", "report"])
+    parser.add_argument("--input-folder", default="output")
+    parser.add_argument("--output-folder", default="output")
+    parser.add_argument("--type", dest="index_type", choices=INDEX_TYPES, default="flat")
+    parser.add_argument("--segments", action="store_true", help="Index segment embeddings")
+    parser.add_argument("--nlist", type=int, default=1024)
+    parser.add_argument("--nprobe", type=int, default=16)
+    parser.add_argument("--pq-m", type=int, default=64)
+    parser.add_argument("--pq-nbits", type=int, default=8)
+    parser.add_argument("--hnsw-m", type=int, default=32)
+    parser.add_argument("--ef-construction", type=int, default=200)
+    parser.add_argument("--ef-search", type=int, default=128)
+    parser.add_argument("--num-queries", type=int, default=1000)
+    args = parser.parse_args()
+
+    index_params = {
+        'nlist': args.nlist, 'nprobe': args.nprobe, 'pq_m': args.pq_m, 'pq_nbits': args.pq_nbits,
+        'hnsw_m': args.hnsw_m, 'ef_construction': args.ef_construction, 'ef_search': args.ef_search
+    }
+
+    if args.command == "build":
+        build_index(args.input_folder, args.output_folder, args.segments, args.index_type, **index_params)
+    else:
+        report_indexes(args.input_folder, segment_mode=args.segments, num_queries=args.num_queries, **index_params)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import copy
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval, fuse_linear_bn_eval
+from train_model_3 import IRBlock
+
+def bf16_supported():
+    # bf16 autocast only pays off with native bf16 instructions (AVX512-BF16 or AMX)
+    checks = [getattr(torch.cpu, name, None) for name in ('_is_avx512_bf16_supported', '_is_amx_tile_supported')]
+    return any(check() for check in checks if check is not None)
+
+def fold_pre_linear_bn(linear, bn, positions):
+    # linear(flatten(bn(x))) where every channel spans `positions` consecutive inputs after
+    # the (linear) average pool, so the per-channel affine folds into the weight and bias
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias - bn.running_mean * scale
+    scale = scale.repeat_interleave(positions)
+    shift = shift.repeat_interleave(positions)
+
+    fused = copy.deepcopy(linear)
+    bias = linear.bias if linear.bias is not None else torch.zeros(linear.out_features)
+    fused.weight = nn.Parameter(linear.weight * scale)
+    fused.bias = nn.Parameter(bias + linear.weight @ shift)
+    return fused
+
+def _fold_block(block):
+    # bn2 and bn3 follow a conv and fold into it. bn1 precedes a zero-padded conv, so folding
+    # it would change the border outputs; it stays as the block's only BatchNorm.
+    block.conv1 = fuse_conv_bn_eval(block.conv1, block.bn2)
+    block.bn2 = nn.Identity()
+    block.conv2 = fuse_conv_bn_eval(block.conv2, block.bn3)
+    block.bn3 = nn.Identity()
+    if block.downsample is not None:
+        block.downsample = fuse_conv_bn_eval(block.downsample[0], block.downsample[1])
+
+def fold_batchnorms(model):
+    # Returns an eval-mode copy of a ResNetFace with the foldable BatchNorms merged into the
+    # adjacent conv/linear weights and dropout removed; forward() is unchanged
+    model = copy.deepcopy(model).eval()
+    with torch.no_grad():
+        model.conv1 = fuse_conv_bn_eval(model.conv1, model.bn1)
+        model.bn1 = nn.Identity()
+
+        for module in model.modules():
+            if isinstance(module, IRBlock):
+                _fold_block(module)
+
+        # bn4 -> avgpool -> flatten -> fc5 -> bn5 collapses into fc5
+        positions = model.fc5.in_features // model.bn4.num_features
+        model.fc5 = fold_pre_linear_bn(model.fc5, model.bn4, positions)
+        model.bn4 = nn.Identity()
+        model.fc5 = fuse_linear_bn_eval(model.fc5, model.bn5)
+        model.bn5 = nn.Identity()
+        model.dropout = nn.Identity()
+    return model
+
+class InferenceModel(nn.Module):
+    # Runs the folded model in channels_last, optionally under bf16 autocast; outputs stay float32
+    def __init__(self, model, channels_last=True, bf16=False):
+        super().__init__()
+        self.model = model
+        self.channels_last = channels_last
+        self.bf16 = bf16
+
+    def forward(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        if self.bf16:
+            with torch.autocast('cpu', dtype=torch.bfloat16):
+                return self.model(x).float()
+        return self.model(x)
+
+def optimize_for_inference(model, channels_last=True, bf16=False, compile_model=False):
+    # bf16=None enables bf16 autocast when the CPU supports it natively
+    if isinstance(model, nn.DataParallel):
+        model = model.module
+    device = next(model.parameters()).device
+    if bf16 is None:
+        bf16 = device.type == 'cpu' and bf16_supported()
+
+    model = fold_batchnorms(model)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    model = InferenceModel(model, channels_last, bf16 and device.type == 'cpu').eval()
+
+    if compile_model:
+        # dynamic=True avoids a recompile for every new batch size
+        model = torch.compile(model, dynamic=True)
+    return model
@@ -0,0 +1,173 @@
+import os
+import csv
+import json
+import numpy as np
+
+COLUMNS = ('id', 'song', 'info', 'title', 'artist')
+
+def split_info(info):
+    if "||" in info:
+        title, artist = info.split("||", 1)
+    else:
+        title, artist = info, "Unknown Artist"
+    return title.strip(), artist.strip()
+
+def file_version(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+class StringTable:
+    # Strings as one utf-8 buffer plus an (n + 1) array of byte offsets
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [s.encode('utf-8') for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        return cls(offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        return bytes(self.data[self.offsets[row]:self.offsets[row + 1]]).decode('utf-8')
+
+    def take(self, rows):
+        return [self[row] for row in rows]
+
+class MetadataStore:
+    # Columnar view of an index's mapping and metadata:
+    #   positions[vector_id]  song row, -1 for ids without a live mapping (tombstoned or uncommitted)
+    #   segment_offsets       time offset of every vector id, for segment indexes
+    #   id/song/info/title/artist  one StringTable per column, indexed by song row
+    # Saved as .npy/.bin files that load memory-mapped, so lookups are array indexing.
+    def __init__(self, positions, columns, segment_offsets=None, sources=None):
+        self.positions = positions
+        self.columns = columns
+        self.segment_offsets = segment_offsets
+        self.sources = sources or {}
+
+    @classmethod
+    def from_mappings(cls, index_to_id, metadata, segment_offsets=None):
+        # Songs without a metadata row are treated as unmapped
+        song_ids = sorted({song_id for song_id in index_to_id.values() if song_id in metadata})
+        rows = {song_id: row for row, song_id in enumerate(song_ids)}
+
+        size = max(index_to_id, default=-1) + 1
+        if segment_offsets:
+            size = max(size, max(segment_offsets) + 1)
+        positions = np.full(size, -1, dtype=np.int32)
+        mapped = [(vector_id, rows[song_id]) for vector_id, song_id in index_to_id.items() if song_id in rows]
+        if mapped:
+            vector_ids, song_rows = zip(*mapped)
+            positions[list(vector_ids)] = song_rows
+
+        offsets = None
+        if segment_offsets is not None:
+            offsets = np.zeros(size, dtype=np.float32)
+            if segment_offsets:
+                offsets[list(segment_offsets.keys())] = list(segment_offsets.values())
+
+        infos = [metadata[song_id]['info'] for song_id in song_ids]
+        titles, artists = zip(*(split_info(info) for info in infos)) if infos else ((), ())
+        columns = {
+            'id': StringTable.from_strings(song_ids),
+            'song': StringTable.from_strings(metadata[song_id]['song'] for song_id in song_ids),
+            'info': StringTable.from_strings(infos),
+            'title': StringTable.from_strings(titles),
+            'artist': StringTable.from_strings(artists)
+        }
+        return cls(positions, columns, offsets)
+
+    @property
+    def num_songs(self):
+        return len(self.columns['id'])
+
+    def resolve(self, indices):
+        # Song rows for faiss ids; -1 for padding and unmapped ids
+        indices = np.asarray(indices)
+        valid = (indices >= 0) & (indices < len(self.positions))
+        return np.where(valid, self.positions[np.where(valid, indices, 0)], -1)
+
+    def column(self, name, rows):
+        return self.columns[name].take(rows)
+
+    def save(self, folder):
+        # Always a fresh folder, normally inside an unpublished release (see index_release), so
+        # no reader can see it until the release pointer names it. A saved store is never rewritten.
+        os.makedirs(folder)
+
+        np.save(os.path.join(folder, "positions.npy"), self.positions)
+        if self.segment_offsets is not None:
+            np.save(os.path.join(folder, "segment_offsets.npy"), self.segment_offsets)
+        for name, table in self.columns.items():
+            np.save(os.path.join(folder, f"{name}_index.npy"), table.offsets)
+            with open(os.path.join(folder, f"{name}.bin"), 'wb') as f:
+                f.write(np.asarray(table.data).tobytes())
+        # Written last: a folder without store.json is incomplete and never loaded
+        with open(os.path.join(folder, "store.json"), 'w', encoding='utf-8') as f:
+            json.dump({'num_songs': self.num_songs, 'num_vectors': len(self.positions),
+                       'segments': self.segment_offsets is not None, 'sources': self.sources}, f)
+
+    @classmethod
+    def load(cls, folder):
+        with open(os.path.join(folder, "store.json"), 'r', encoding='utf-8') as f:
+            header = json.load(f)
+
+        positions = np.load(os.path.join(folder, "positions.npy"), mmap_mode='r')
+        segment_offsets = None
+        if header['segments']:
+            segment_offsets = np.load(os.path.join(folder, "segment_offsets.npy"), mmap_mode='r')
+
+        columns = {}
+        for name in COLUMNS:
+            offsets = np.load(os.path.join(folder, f"{name}_index.npy"), mmap_mode='r')
+            data_path = os.path.join(folder, f"{name}.bin")
+            # np.memmap cannot map an empty file
+            data = np.memmap(data_path, dtype=np.uint8, mode='r') if os.path.getsize(data_path) \
+                else np.empty(0, dtype=np.uint8)
+            columns[name] = StringTable(offsets, data)
+        return cls(positions, columns, segment_offsets, header.get('sources'))
+
+def store_folder(mapping_path):
+    return f"{os.path.splitext(mapping_path)[0]}_store"
+
+def read_metadata_store(mapping_path, metadata_path):
+    # The only place the JSON mapping and metadata CSV are parsed
+    with open(mapping_path, 'r', encoding='utf-8') as f:
+        mappings = json.load(f)
+    deleted = set(mappings.get('deleted', []))
+    entries = {int(k): v for k, v in mappings['metadata'].items()}
+    index_to_id = {k: v['id'] for k, v in entries.items() if k not in deleted}
+    segment_offsets = None
+    if any('offset' in v for v in entries.values()):
+        segment_offsets = {k: v.get('offset', 0.0) for k, v in entries.items()}
+
+    metadata = {}
+    with open(metadata_path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            metadata[row['id']] = {'song': row['song'], 'info': row['info']}
+
+    store = MetadataStore.from_mappings(index_to_id, metadata, segment_offsets)
+    store.sources = {'mapping': file_version(mapping_path), 'metadata': file_version(metadata_path)}
+    return store
+
+def build_metadata_store(mapping_path, metadata_path, folder):
+    # Writers only: folder must not exist yet
+    store = read_metadata_store(mapping_path, metadata_path)
+    store.save(folder)
+    return store
+
+def load_metadata_store(mapping_path, metadata_path, folder=None):
+    # Memory-maps the saved store if it was built from these exact files. Readers never write:
+    # a missing or stale store (flat files from before releases) is parsed in memory instead.
+    folder = folder or store_folder(mapping_path)
+    if os.path.exists(os.path.join(folder, "store.json")):
+        store = MetadataStore.load(folder)
+        if store.sources == {'mapping': file_version(mapping_path), 'metadata': file_version(metadata_path)}:
+            return store
+    print(f"No current metadata store in {folder}, reading {mapping_path} and {metadata_path}")
+    return read_metadata_store(mapping_path, metadata_path)
@@ -0,0 +1,84 @@
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from tqdm import tqdm
+
+# Kept free of numpy/torch imports so worker thread limits apply before those load
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                   'NUMEXPR_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS')
+
+def limit_threads(threads):
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(threads)
+    if 'torch' in sys.modules:
+        sys.modules['torch'].set_num_threads(threads)
+
+def _run_task(fn, task):
+    try:
+        return fn(*task)
+    except Exception as e:
+        print(f"Error running {getattr(fn, '__name__', fn)}{task}: {e}")
+        return None
+
+def _create_executor(num_workers, max_tasks_per_child, threads_per_worker):
+    kwargs = {'max_workers': num_workers, 'initializer': limit_threads, 'initargs': (threads_per_worker,)}
+    if max_tasks_per_child:
+        try:
+            # Recycling workers bounds memory growth; uses the 'spawn' start method
+            return ProcessPoolExecutor(max_tasks_per_child=max_tasks_per_child, **kwargs)
+        except TypeError:
+            pass  # Python < 3.11
+    return ProcessPoolExecutor(**kwargs)
+
+def run_parallel(fn, tasks, num_workers=8, max_in_flight=None, max_tasks_per_child=64,
+                 threads_per_worker=1, key=None, desc=None):
+    # Yields (task, result) as tasks complete; fn is called as fn(*task).
+    # Tasks with the same key run once and share the result.
+    tasks = list(tasks)
+    key = key or (lambda task: task)
+    max_in_flight = max_in_flight or 2 * num_workers
+
+    duplicates = {}
+    unique = []
+    for task in tasks:
+        task_key = key(task)
+        if task_key in duplicates:
+            duplicates[task_key].append(task)
+        else:
+            duplicates[task_key] = [task]
+            unique.append((task_key, task))
+
+    progress = tqdm(total=len(tasks), desc=desc)
+    try:
+        if num_workers <= 1:
+            for task_key, task in unique:
+                result = _run_task(fn, task)
+                for duplicate in duplicates[task_key]:
+                    progress.update(1)
+                    yield duplicate, result
+            return
+
+        with _create_executor(num_workers, max_tasks_per_child, threads_per_worker) as executor:
+            pending = {}
+            queue = iter(unique)
+
+            def submit_next():
+                for task_key, task in queue:
+                    pending[executor.submit(_run_task, fn, task)] = task_key
+                    return True
+                return False
+
+            while len(pending) < max_in_flight and submit_next():
+                pass
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task_key = pending.pop(future)
+                    result = future.result()
+                    for duplicate in duplicates[task_key]:
+                        progress.update(1)
+                        yield duplicate, result
+                    submit_next()
+    finally:
+        progress.close()
@@ -3,45 +3,23 @@ import librosa
 import soundfile as sf
 import numpy as np
 import csv
-from concurrent.futures import ProcessPoolExecutor
-from tqdm import tqdm
 import subprocess
+from parallel import run_parallel
+from audio_decoder import get_decoder
 
-def load_audio(file_path):
-    try:
-        audio_data, sr = sf.read(file_path)
-        if len(audio_data.shape) > 1:
-            audio_data = np.mean(audio_data, axis=1)
-    except Exception:
-        try:
-            command = [
-                'ffmpeg',
-                '-i', file_path,
-                '-f', 'f32le',
-                '-acodec', 'pcm_f32le',
-                '-ac', '1',
-                '-ar', '48000',
-                'pipe:'
-            ]
-
-            process = subprocess.Popen(
-                command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-
-            out, err = process.communicate()
-
-            if process.returncode != 0:
-                raise RuntimeError(f"FFmpeg error: {err.decode()}")
-
-            audio_data = np.frombuffer(out, dtype=np.float32)
-            sr = 48000
+STREAM_BLOCK_SIZE = 512 * 1024
+STREAMING_THRESHOLD_BYTES = 32 * 1024 * 1024
+TRIM_FRAME_LENGTH = 2048
+TRIM_HOP_LENGTH = 512
+MP3_BITRATE_KBPS = 128
 
-        except Exception as e:
-            raise RuntimeError(f"Failed to load audio file {file_path}: {str(e)}")
+def load_audio(file_path, sr=None, quality='high'):
+    # Decodes in-process where libsndfile can; sr resamples straight to the rate the next stage needs
+    return get_decoder(sr, quality).decode(file_path)
 
-    return audio_data, sr
+def open_audio_stream(file_path, sr=None, block_size=STREAM_BLOCK_SIZE, quality='high'):
+    # Returns (blocks, sr); blocks yields mono float32 arrays
+    return get_decoder(sr, quality).stream(file_path, block_size)
 
 def is_valid_sound(audio_data, sr, min_dur=0.5, max_dur=None):
     dur = len(audio_data) / sr
@@ -56,8 +34,45 @@ def adjust_volume(audio_data, target_db=-20.0):
     adjustment = target_db - current_db
     return audio_data * (10 ** (adjustment / 20))
 
+def preprocess_audio(audio_data, sr, min_dur=0.5, max_dur=None, target_db=-20.0):
+    audio_data = adjust_volume(audio_data, target_db)
+    audio_data = trim_silence(audio_data, sr)
+
+    if not is_valid_sound(audio_data, sr, min_dur, max_dur):
+        return None
+
+    return librosa.util.normalize(audio_data)
+
+def _mp3_compression_level(sr, bitrate=MP3_BITRATE_KBPS):
+    # libsndfile maps compression level linearly onto the bitrate range of the MPEG version
+    if sr >= 32000:
+        low, high = 32, 320
+    elif sr >= 16000:
+        low, high = 8, 160
+    else:
+        low, high = 8, 64
+    return (high - min(max(bitrate, low), high)) / (high - low)
+
+def _mp3_writer(sr, output_path):
+    # In-process 128 kbps CBR encoder; None if this libsndfile cannot write MP3
+    if 'MP3' not in sf.available_formats():
+        return None
+    try:
+        return sf.SoundFile(output_path, 'w', sr, 1, format='MP3', bitrate_mode='CONSTANT',
+                            compression_level=_mp3_compression_level(sr))
+    except TypeError:
+        return None  # soundfile < 0.12
+    except sf.LibsndfileError:
+        return None  # e.g. a sample rate MPEG does not support
+
 def save_audio(audio_data, sr, output_path):
     try:
+        writer = _mp3_writer(sr, output_path)
+        if writer is not None:
+            with writer:
+                writer.write(np.asarray(audio_data, dtype=np.float32))
+            return True
+
         audio_int16 = (audio_data * 32767).astype(np.int16)
 
         command = [
@@ -88,19 +103,168 @@ def save_audio(audio_data, sr, output_path):
         print(f"Error saving audio: {str(e)}")
         return False
 
+def save_audio_stream(blocks, sr, output_path):
+    writer = _mp3_writer(sr, output_path)
+    if writer is not None:
+        try:
+            with writer:
+                for block in blocks:
+                    writer.write(block)
+            return True
+        except Exception as e:
+            print(f"Error saving audio: {str(e)}")
+            return False
+
+    command = [
+        'ffmpeg',
+        '-loglevel', 'error',
+        '-f', 's16le',
+        '-ar', str(sr),
+        '-ac', '1',
+        '-i', 'pipe:',
+        '-c:a', 'libmp3lame',
+        '-y',
+        output_path
+    ]
+
+    process = subprocess.Popen(
+        command,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE
+    )
+
+    try:
+        for block in blocks:
+            process.stdin.write((block * 32767).astype(np.int16).tobytes())
+        process.stdin.close()
+        err = process.stderr.read()
+        if process.wait() != 0:
+            raise RuntimeError(f"FFmpeg error: {err.decode()}")
+        return True
+    except Exception as e:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        print(f"Error saving audio: {str(e)}")
+        return False
+
+def analyze_audio_stream(blocks, hop_length=TRIM_HOP_LENGTH):
+    # Per-hop energy and peak, enough to reproduce adjust_volume, trim_silence and normalize
+    hop_energy = []
+    hop_peak = []
+    remainder = np.empty(0, dtype=np.float32)
+    total_energy = 0.0
+    length = 0
+
+    for block in blocks:
+        block = block.astype(np.float64)
+        total_energy += float(np.sum(block ** 2))
+        length += len(block)
+
+        if len(remainder):
+            block = np.concatenate([remainder, block])
+        usable = len(block) - len(block) % hop_length
+        hops = block[:usable].reshape(-1, hop_length)
+        hop_energy.append(np.sum(hops ** 2, axis=1))
+        hop_peak.append(np.max(np.abs(hops), axis=1, initial=0.0))
+        remainder = block[usable:]
+
+    if len(remainder):
+        hop_energy.append(np.array([np.sum(remainder ** 2)]))
+        hop_peak.append(np.array([np.max(np.abs(remainder))]))
+
+    hop_energy = np.concatenate(hop_energy) if hop_energy else np.empty(0)
+    hop_peak = np.concatenate(hop_peak) if hop_peak else np.empty(0)
+    return length, total_energy, hop_energy, hop_peak
+
+def find_trim_bounds(length, hop_energy, gain=1.0, top_db=60,
+                     frame_length=TRIM_FRAME_LENGTH, hop_length=TRIM_HOP_LENGTH):
+    # Same frames as librosa.effects.trim: centered, zero-padded rms over frame_length
+    hops_per_frame = frame_length // hop_length
+    pad_hops = hops_per_frame // 2
+    num_frames = 1 + length // hop_length
+
+    padded = np.zeros(num_frames + hops_per_frame)
+    padded[pad_hops:pad_hops + len(hop_energy)] = hop_energy
+    window_energy = np.convolve(padded, np.ones(hops_per_frame), mode='valid')[:num_frames]
+    rms = np.sqrt(np.maximum(window_energy, 0.0) / frame_length) * gain
+
+    db = librosa.amplitude_to_db(rms, ref=np.max, top_db=None)
+    nonzero = np.flatnonzero(db > -top_db)
+    if nonzero.size == 0:
+        return 0, 0
+
+    start = int(nonzero[0] * hop_length)
+    end = min(length, int((nonzero[-1] + 1) * hop_length))
+    return start, end
+
+def iter_audio_segment(blocks, start, end, scale):
+    position = 0
+    for block in blocks:
+        block_start = max(start - position, 0)
+        block_end = min(end - position, len(block))
+        position += len(block)
+        if block_end > block_start:
+            yield block[block_start:block_end] * scale
+        if position >= end:
+            break
+
+def stream_preprocessed_audio(input_path, sr=None, min_dur=0.5, max_dur=None, target_db=-20.0,
+                              block_size=STREAM_BLOCK_SIZE, quality='high'):
+    # Streaming preprocess_audio: returns (blocks, sr), or None if the sound is invalid.
+    # The first pass collects statistics, the returned blocks are the second pass.
+    blocks, sr = open_audio_stream(input_path, sr=sr, block_size=block_size, quality=quality)
+    length, total_energy, hop_energy, hop_peak = analyze_audio_stream(blocks)
+    if length == 0:
+        return None
+
+    rms = np.sqrt(total_energy / length)
+    gain = 10 ** ((target_db - 20 * np.log10(max(rms, 1e-10))) / 20)
+
+    start, end = find_trim_bounds(length, hop_energy, gain)
+    duration = (end - start) / sr
+    if not (min_dur < duration and (max_dur is None or duration < max_dur)):
+        return None
+
+    peak = gain * np.max(hop_peak[start // TRIM_HOP_LENGTH:-(-end // TRIM_HOP_LENGTH)])
+    scale = gain / peak if peak > np.finfo(np.float32).tiny else gain
+
+    blocks, sr = open_audio_stream(input_path, sr=sr, block_size=block_size, quality=quality)
+    return iter_audio_segment(blocks, start, end, scale), sr
+
+def process_file_streaming(args, block_size=STREAM_BLOCK_SIZE):
+    input_path, output_path, min_dur, max_dur, target_db = args
+    try:
+        if not os.path.isfile(input_path):
+            raise FileNotFoundError(f"{input_path} not found")
+
+        stream = stream_preprocessed_audio(input_path, None, min_dur, max_dur, target_db, block_size)
+        if stream is None:
+            return False
+
+        blocks, sr = stream
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        return save_audio_stream(blocks, sr, output_path)
+
+    except Exception as e:
+        print(f"Error processing {input_path}: {str(e)}")
+        return False
+
 def process_file(args):
     input_path, output_path, min_dur, max_dur, target_db = args
     try:
         if not os.path.isfile(input_path):
             raise FileNotFoundError(f"{input_path} not found")
 
+        if os.path.getsize(input_path) > STREAMING_THRESHOLD_BYTES:
+            return process_file_streaming(args)
+
         audio_data, sr = load_audio(input_path)
 
-        audio_data = adjust_volume(audio_data, target_db)
-        audio_data = trim_silence(audio_data, sr)
+        audio_data = preprocess_audio(audio_data, sr, min_dur, max_dur, target_db)
 
-        if is_valid_sound(audio_data, sr, min_dur, max_dur):
-            audio_data = librosa.util.normalize(audio_data)
+        if audio_data is not None:
             os.makedirs(os.path.dirname(output_path), exist_ok=True)
             success = save_audio(audio_data, sr, output_path)
             return success
@@ -138,17 +302,17 @@ def process_data(data_folder, output_folder, target_db=-20.0, num_workers=8):
                 row
             ))
 
-    with ProcessPoolExecutor(max_workers=num_workers) as executor:
-        for (hum_args, song_args, row) in tqdm(processing_args, desc="Processing Files"):
-            hum_future = executor.submit(process_file, hum_args)
-            song_future = executor.submit(process_file, song_args)
-
-            if hum_future.result() and song_future.result():
-                output_metadata.append([row['id'],
-                                     os.path.basename(hum_args[1]),
-                                     os.path.basename(song_args[1])])
-            else:
-                print(f"Skipping {row['id']} due to processing failure.")
+    # The same song appears in many hum rows; run_parallel processes it once
+    tasks = [(args,) for hum_args, song_args, _ in processing_args for args in (hum_args, song_args)]
+    results = dict(run_parallel(process_file, tasks, num_workers=num_workers, desc="Processing Files"))
+
+    for (hum_args, song_args, row) in processing_args:
+        if results[(hum_args,)] and results[(song_args,)]:
+            output_metadata.append([row['id'],
+                                 os.path.basename(hum_args[1]),
+                                 os.path.basename(song_args[1])])
+        else:
+            print(f"Skipping {row['id']} due to processing failure.")
 
     output_metadata_file = os.path.join(output_folder, "metadata.csv")
     with open(output_metadata_file, "w", newline="", encoding='utf-8') as csvfile:
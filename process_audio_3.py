@@ -1,47 +1,304 @@
 import os
+import functools
 import numpy as np
 import torch
 import librosa
-import joblib
+import soundfile as sf
 import csv
 import random
+import struct
 from librosa.filters import mel as librosa_mel_fn
+from parallel import run_parallel
+from process_audio_1 import (load_audio, open_audio_stream, preprocess_audio, stream_preprocessed_audio,
+                             STREAM_BLOCK_SIZE, STREAMING_THRESHOLD_BYTES)
 
-def process_audio(audio, sr=22050, n_mels=80, n_fft=1024, hop_length=256, win_length=1024,
-                 fmin=0.0, fmax=8000.0):
-    waveform = torch.FloatTensor(audio)
+MEL_PARAMS = {'sr': 22050, 'n_mels': 80, 'n_fft': 1024, 'hop_length': 256, 'win_length': 1024,
+              'fmin': 0.0, 'fmax': 8000.0}
+
+@functools.lru_cache(maxsize=None)
+def get_mel_basis(sr, n_fft, n_mels, fmin, fmax):
     mel_basis = librosa_mel_fn(sr=sr, n_fft=n_fft, n_mels=n_mels, fmin=fmin, fmax=fmax)
-    mel_basis = torch.from_numpy(mel_basis).float()
-
-    spec = torch.stft(
-        waveform,
-        n_fft=n_fft,
-        hop_length=hop_length,
-        win_length=win_length,
-        window=torch.hann_window(win_length),
-        return_complex=True
-    )
-    spec = torch.abs(spec)
-    mel = torch.matmul(mel_basis, spec)
-    mel = torch.log(torch.clamp(mel, min=1e-5))
-
-    return mel.numpy()
+    return torch.from_numpy(mel_basis).float()
+
+@functools.lru_cache(maxsize=None)
+def get_hann_window(win_length):
+    return torch.hann_window(win_length)
+
+class MelFrontend:
+    def __init__(self, sr=22050, n_mels=80, n_fft=1024, hop_length=256, win_length=1024,
+                 fmin=0.0, fmax=8000.0):
+        self.sr = sr
+        self.n_mels = n_mels
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.win_length = win_length
+        self.mel_basis = get_mel_basis(sr, n_fft, n_mels, fmin, fmax)
+        self.window = get_hann_window(win_length)
+
+    def num_frames(self, length):
+        # Same frame count as torch.stft(center=True)
+        return 1 + length // self.hop_length
+
+    def __call__(self, audio):
+        return self.process_batch([audio])[0]
+
+    def process_batch(self, waveforms, lengths=None):
+        if lengths is None:
+            waveforms = [torch.as_tensor(np.asarray(w), dtype=torch.float32) for w in waveforms]
+            if not waveforms:
+                return []
+            lengths = [w.shape[0] for w in waveforms]
+            padded = torch.nn.utils.rnn.pad_sequence(waveforms, batch_first=True)
+        else:
+            if len(lengths) == 0:
+                return []
+            padded = torch.as_tensor(np.asarray(waveforms), dtype=torch.float32)
+
+        mel = self.mel_frames(self.reflect_pad(padded, lengths))
+        return [mel[i, :, :self.num_frames(length)].numpy() for i, length in enumerate(lengths)]
+
+    def reflect_pad(self, padded, lengths):
+        # Reflect-pads every clip at its own edges, as center=True does, with whole-batch ops:
+        # the start edge is one flipped slice, the end edges one gather and one scatter.
+        # Anything past a clip's padded end is zero.
+        pad = self.n_fft // 2
+        if min(lengths) <= pad:
+            raise ValueError(f"Clips must be longer than {pad} samples, got {min(lengths)}")
+
+        lengths = torch.as_tensor(lengths, dtype=torch.long).unsqueeze(1)
+        width = padded.shape[1]
+        batch = torch.zeros(padded.shape[0], width + 2 * pad)
+        batch[:, pad:pad + width] = padded * (torch.arange(width) < lengths)
+        batch[:, :pad] = padded[:, 1:pad + 1].flip(1)
+
+        steps = torch.arange(1, pad + 1)
+        batch.scatter_(1, lengths + pad - 1 + steps, torch.gather(padded, 1, lengths - 1 - steps))
+        return batch
+
+    def mel_frames(self, padded):
+        # Log-mel of signals that already carry their edge padding (center=False)
+        spec = torch.stft(
+            padded,
+            n_fft=self.n_fft,
+            hop_length=self.hop_length,
+            win_length=self.win_length,
+            window=self.window,
+            center=False,
+            return_complex=True
+        )
+        spec = torch.abs(spec)
+        mel = torch.matmul(self.mel_basis, spec)
+        return torch.log(torch.clamp(mel, min=1e-5))
+
+class StreamingMel:
+    # Incremental MelFrontend: push blocks of audio, get the same frames as one full call
+    def __init__(self, frontend):
+        self.frontend = frontend
+        self.pad = frontend.n_fft // 2
+        self.reset()
+
+    def reset(self):
+        self._buffer = np.empty(0, dtype=np.float32)
+        self._tail = np.empty(0, dtype=np.float32)
+        self._started = False
+
+    def _empty(self):
+        return np.empty((self.frontend.n_mels, 0), dtype=np.float32)
+
+    def _emit(self):
+        n_fft, hop_length = self.frontend.n_fft, self.frontend.hop_length
+        if len(self._buffer) < n_fft:
+            return self._empty()
+
+        num_frames = 1 + (len(self._buffer) - n_fft) // hop_length
+        used = (num_frames - 1) * hop_length + n_fft
+        mel = self.frontend.mel_frames(torch.from_numpy(self._buffer[:used]))
+        self._buffer = self._buffer[num_frames * hop_length:]
+        return mel.numpy()
+
+    def push(self, block):
+        block = np.asarray(block, dtype=np.float32)
+        self._tail = np.concatenate([self._tail, block])[-(self.pad + 1):]
+        self._buffer = np.concatenate([self._buffer, block])
+
+        if not self._started:
+            if len(self._buffer) <= self.pad:
+                return self._empty()
+            # Reflect padding at the start, as torch.stft(center=True) does
+            self._buffer = np.concatenate([self._buffer[1:self.pad + 1][::-1], self._buffer])
+            self._started = True
+
+        return self._emit()
+
+    def flush(self):
+        if not self._started:
+            mel = self.frontend(self._buffer)
+        else:
+            self._buffer = np.concatenate([self._buffer, self._tail[-self.pad - 1:-1][::-1]])
+            mel = self._emit()
+        self.reset()
+        return mel
+
+class NpyFrameWriter:
+    # Writes an (n_mels, frames) .npy column by column without knowing the frame count up front
+    HEADER_SIZE = 128
+
+    def __init__(self, path, n_mels):
+        self.path = path if path.endswith('.npy') else path + '.npy'
+        self.n_mels = n_mels
+        self.num_frames = 0
+        self._file = open(self.path, 'wb')
+        self._write_header()
+
+    def _write_header(self):
+        # Fortran order lets frames be appended contiguously; np.load handles it transparently
+        header = "{'descr': '<f4', 'fortran_order': True, 'shape': (%d, %d), }" % (self.n_mels, self.num_frames)
+        header = header.ljust(self.HEADER_SIZE - 11) + '\n'
+        self._file.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1'))
+
+    def write(self, mel):
+        if mel.shape[1] == 0:
+            return
+        self._file.write(np.ascontiguousarray(mel.T, dtype='<f4').tobytes())
+        self.num_frames += mel.shape[1]
+
+    def close(self):
+        self._file.seek(0)
+        self._write_header()
+        self._file.close()
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+@functools.lru_cache(maxsize=None)
+def _cached_mel_frontend(sr, n_mels, n_fft, hop_length, win_length, fmin, fmax):
+    return MelFrontend(sr=sr, n_mels=n_mels, n_fft=n_fft, hop_length=hop_length,
+                       win_length=win_length, fmin=fmin, fmax=fmax)
+
+def get_mel_frontend(sr=None, **mel_params):
+    # One frontend per parameter set: MEL_PARAMS, overridden by whatever is given
+    mel_params = dict(MEL_PARAMS, **mel_params)
+    if sr is not None:
+        mel_params['sr'] = sr
+    return _cached_mel_frontend(**mel_params)
+
+def process_audio(audio, sr=None, **mel_params):
+    return get_mel_frontend(sr, **mel_params)(audio)
+
+def prepare_audio(audio, sr, target_sr=22050, min_dur=0.5, max_dur=None, target_db=-20.0):
+    # Mono, trimmed, normalized audio at target_sr, or None if the sound is invalid.
+    # Resampled before trimming, so silence is cut on the target_sr grid whatever the input
+    # rate, as in stream_preprocessed_audio.
+    audio = np.asarray(audio)
+    if np.issubdtype(audio.dtype, np.integer):
+        audio = audio / np.iinfo(audio.dtype).max
+    if audio.ndim > 1:
+        audio = np.mean(audio, axis=1)
+    audio = audio.astype(np.float32)
+
+    if sr != target_sr:
+        audio = librosa.resample(audio, orig_sr=sr, target_sr=target_sr)
+
+    return preprocess_audio(audio, target_sr, min_dur, max_dur, target_db)
+
+def audio_to_mel(audio, sr, target_sr=22050, min_dur=0.5, max_dur=None, target_db=-20.0):
+    # In-memory equivalent of process_audio_1.process_file followed by process_file
+    audio = prepare_audio(audio, sr, target_sr, min_dur, max_dur, target_db)
+    if audio is None:
+        return None
+    return process_audio(audio, sr=target_sr)
 
 def normalize_filename(filename):
     return filename.encode('ascii', 'ignore').decode().replace('\'', "'").replace('"', "'")
 
-def process_file(audio_path, out_path, sr=22050):
+def process_file_streaming(audio_path, out_path, mel_params=None, block_size=STREAM_BLOCK_SIZE, quality='high'):
+    mel_params = mel_params or MEL_PARAMS
+    sr = mel_params['sr']
+    streaming_mel = StreamingMel(get_mel_frontend(**mel_params))
+    writer = NpyFrameWriter(out_path, streaming_mel.frontend.n_mels)
+    try:
+        blocks, _ = open_audio_stream(audio_path, sr=sr, block_size=block_size, quality=quality)
+        for block in blocks:
+            writer.write(streaming_mel.push(block))
+        writer.write(streaming_mel.flush())
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
+
+def process_file(audio_path, out_path, mel_params=None, quality='high'):
+    # mel_params defaults to MEL_PARAMS; every value in it shapes the output
+    mel_params = mel_params or MEL_PARAMS
     try:
-        audio, _ = librosa.load(audio_path, sr=sr)
-        spec = process_audio(audio, sr=sr)
         normalized_out_path = normalize_filename(out_path)
+        if os.path.getsize(audio_path) > STREAMING_THRESHOLD_BYTES:
+            process_file_streaming(audio_path, normalized_out_path, mel_params=mel_params, quality=quality)
+            return True
+
+        audio, _ = load_audio(audio_path, sr=mel_params['sr'], quality=quality)
+        spec = process_audio(audio, **mel_params)
         np.save(normalized_out_path, spec)
         return True
     except Exception as e:
         print(f"Error processing {audio_path}: {e}")
         return False
 
-def process_data(data_folder, output_folder):
+def process_file_fused(input_path, out_path, min_dur=0.5, max_dur=None, target_db=-20.0,
+                       pcm_path=None, mel_params=None, quality='high'):
+    # Decode once, then trim/normalize, resample and write the mel without an mp3 in between.
+    # pcm_path optionally keeps the prepared audio as lossless 16-bit PCM WAV at the mel rate.
+    mel_params = mel_params or MEL_PARAMS
+    sr = mel_params['sr']
+    try:
+        if not os.path.isfile(input_path):
+            raise FileNotFoundError(f"{input_path} not found")
+
+        normalized_out_path = normalize_filename(out_path)
+        if pcm_path:
+            os.makedirs(os.path.dirname(pcm_path), exist_ok=True)
+
+        if os.path.getsize(input_path) > STREAMING_THRESHOLD_BYTES:
+            stream = stream_preprocessed_audio(input_path, sr, min_dur, max_dur, target_db, quality=quality)
+            if stream is None:
+                return False
+
+            blocks, _ = stream
+            streaming_mel = StreamingMel(get_mel_frontend(**mel_params))
+            writer = NpyFrameWriter(normalized_out_path, streaming_mel.frontend.n_mels)
+            pcm_file = sf.SoundFile(pcm_path, 'w', samplerate=sr, channels=1, subtype='PCM_16') if pcm_path else None
+            try:
+                for block in blocks:
+                    writer.write(streaming_mel.push(block))
+                    if pcm_file is not None:
+                        pcm_file.write(block)
+                writer.write(streaming_mel.flush())
+                writer.close()
+            except Exception:
+                writer.abort()
+                raise
+            finally:
+                if pcm_file is not None:
+                    pcm_file.close()
+            return True
+
+        # Decoded straight at sr and trimmed there, like the streaming path above
+        audio, decoded_sr = load_audio(input_path, sr=sr, quality=quality)
+        audio = prepare_audio(audio, decoded_sr, sr, min_dur, max_dur, target_db)
+        if audio is None:
+            return False
+
+        if pcm_path:
+            sf.write(pcm_path, audio, sr, subtype='PCM_16')
+        np.save(normalized_out_path, process_audio(audio, **mel_params))
+        return True
+
+    except Exception as e:
+        print(f"Error processing {input_path}: {e}")
+        return False
+
+def process_data(data_folder, output_folder, num_workers=4):
     random.seed(1234)
     test_ratio = 0.2
 
@@ -60,12 +317,9 @@ def process_data(data_folder, output_folder):
         os.makedirs(output_path, exist_ok=True)
         files = [f for f in os.listdir(input_path) if f.endswith('.mp3')]
 
-        jobs = [joblib.delayed(process_file)(
-            os.path.join(input_path, f),
-            os.path.join(output_path, f"{f[:-4]}.npy")
-        ) for f in files]
-
-        joblib.Parallel(n_jobs=4, verbose=1)(jobs)
+        tasks = [(os.path.join(input_path, f), os.path.join(output_path, f"{f[:-4]}.npy")) for f in files]
+        for _ in run_parallel(process_file, tasks, num_workers=num_workers, desc=f"Processing {sub}"):
+            pass
 
     if os.path.exists(os.path.join(input_dir, "metadata.csv")):
         input_metadata = os.path.join(input_dir, "metadata.csv")
@@ -0,0 +1,66 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+class MicroBatcher:
+    # Runs process_batch(items) -> results on batches of concurrently submitted items.
+    # A request that finds the worker idle runs at once, so a lone query pays no wait.
+    # Requests queued behind a running batch form the next one, held open for up to
+    # max_wait seconds to fill it.
+    def __init__(self, process_batch, max_batch=32, max_wait=0.002):
+        self.process_batch = process_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.batches = 0
+        self.items = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        future = Future()
+        self._queue.put((item, future))
+        return future.result()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        # Others were already waiting: we are under load, so give stragglers a moment
+        if 1 < len(batch) < self.max_batch and self.max_wait > 0:
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            self.batches += 1
+            self.items += len(batch)
+            try:
+                results = self.process_batch([item for item, _ in batch])
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                    continue
+                # One bad request fails the whole batch: rerun them one by one so only it fails
+                for item, future in batch:
+                    try:
+                        future.set_result(self.process_batch([item])[0])
+                    except Exception as e:
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
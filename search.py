@@ -1,9 +1,25 @@
 import os
+import faiss
+import numpy as np
 from search_1 import search_1
 from search_2 import search_2
-from search_3 import search_3
-import json
+from search_3 import (search_3, search_embeddings, search_segments_batch, INDEX_PATH, MAPPING_PATH, METADATA_PATH,
+                      SEGMENT_INDEX_PATH, SEGMENT_MAPPING_PATH, SEGMENT_METADATA_PATH)
+from metadata_store import load_metadata_store, split_info
+from index_release import load_release, release_version
+from inference_2 import EmbeddingGenerator
+from process_audio_1 import load_audio
+from process_audio_3 import prepare_audio, process_audio
+from artifact_cache import array_hash
+from query_cache import QueryCache
+from query_batcher import MicroBatcher
+import time
 import shutil
+import threading
+from collections import namedtuple
+
+MODEL_PATH = os.path.join("checkpoints", "resnetface_best.pth")
+MEL_SAMPLE_RATE = 22050
 
 def setup_search_directories():
     directories = ['search', 'search/processed', 'search/embedding', 'search/results']
@@ -20,55 +36,235 @@ def copy_input_file(input_file):
     shutil.copy2(input_file, output_path)
     return output_path
 
-def run_search_pipeline(input_file):
-    try:
-        cleanup_search_directories()
-        setup_search_directories()
+def format_results(search_results, limit=20):
+    formatted_results = []
+    seen_songs = set()
+
+    for query_name, query_results in search_results.items():
+        for match in query_results['matches']:
+            song_info = match['info']
+
+            if song_info in seen_songs:
+                continue
+
+            seen_songs.add(song_info)
+
+            # Matches from the metadata store carry the split title and artist already
+            if 'title' in match:
+                title, artist = match['title'], match['artist']
+            else:
+                title, artist = split_info(song_info)
+
+            max_distance = 1000.0
+            confidence = max(0, min(100, (1 - match['distance'] / max_distance) * 100))
+
+            result = {
+                "title": title,
+                "artist": artist,
+                "match": f"{confidence:.1f}%"
+            }
+            if 'offset' in match:
+                result["offset"] = match['offset']
+
+            # Segment searches rank by their aggregated score rather than the raw distance
+            formatted_results.append((match.get('score', confidence), result))
+
+    formatted_results.sort(key=lambda x: x[0], reverse=True)
+
+    return [result for _, result in formatted_results[:limit]]
+
+def file_version(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+# Everything one query reads. A reload builds a new state and swaps it in whole, so a query
+# and the batch it joins always see a model, index and lookup from the same version.
+SearchState = namedtuple('SearchState', ['version', 'generator', 'index', 'lookup'])
+
+class SearchEngine:
+    def __init__(self, model_path=MODEL_PATH, index_path=None, mapping_path=None,
+                 metadata_path=None, device=None, segment_mode=False, aggregate='max',
+                 cache_size=256, cache_ttl=600.0, max_batch=32, max_wait=0.002, top_k=20, backend='torch',
+                 optimize=False, bf16=False, input_mode='resize', refresh_interval=1.0):
+        # model_path is an exported model for the torchscript/onnx backends, see export_model.py
+        self.model_path = model_path
+        self.device = device
+        # input_mode must match the one the index embeddings were generated with
+        self.generator_options = {'backend': backend, 'optimize': optimize, 'bf16': bf16, 'input_mode': input_mode}
+        self.segment_mode = segment_mode
+        self.aggregate = aggregate
+        self.top_k = top_k
+        self.refresh_interval = refresh_interval
+
+        if segment_mode:
+            index_path = index_path or SEGMENT_INDEX_PATH
+            mapping_path = mapping_path or SEGMENT_MAPPING_PATH
+            metadata_path = metadata_path or SEGMENT_METADATA_PATH
+        else:
+            index_path = index_path or INDEX_PATH
+            mapping_path = mapping_path or MAPPING_PATH
+            metadata_path = metadata_path or METADATA_PATH
+
+        self.index_path = index_path
+        self.mapping_path = mapping_path
+        self.metadata_path = metadata_path
 
-        copy_input_file(input_file)
+        self.state = self.load_state(self.current_version())
+        self._next_refresh = time.monotonic() + refresh_interval
+        self._unsettled = None
+        # The file-based steps share the 'search' working directory
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self.cache = QueryCache(cache_size, cache_ttl)
+        # Concurrent queries share one forward pass and one index.search
+        self.batcher = MicroBatcher(self._search_batch, max_batch, max_wait)
 
-        search_1('search', 'search')
-        search_2('search', 'search', 'checkpoints/resnetface_best.pth')
-        results = search_3('search', 'search')
+    @property
+    def version(self):
+        return self.state.version
 
-        results_file = os.path.join('search', 'results', 'search_results.json')
-        if os.path.exists(results_file):
-            with open(results_file, 'r', encoding='utf-8', errors='replace') as f:
-                search_results = json.load(f)
+    @property
+    def generator(self):
+        return self.state.generator
 
-            # Format results for UI
-            formatted_results = []
-            seen_songs = set()
+    @property
+    def index(self):
+        return self.state.index
 
-            for query_name, query_results in search_results.items():
-                for match in query_results['matches']:
-                    song_info = match['info']
+    @property
+    def lookup(self):
+        return self.state.lookup
 
-                    if song_info in seen_songs:
-                        continue
+    def load_state(self, version, generator=None):
+        # Ids and song strings come from the memory-mapped metadata store, not JSON/CSV dicts
+        if generator is None:
+            generator = EmbeddingGenerator(self.model_path, device=self.device, **self.generator_options)
+        release = load_release(self.index_path, self.mapping_path, self.metadata_path)
+        print(f"Loading index from: {release.index_path}")
+        index = faiss.read_index(release.index_path)
+        lookup = load_metadata_store(release.mapping_path, release.metadata_path, release.store_folder)
+        print(f"Loaded index with dimension: {index.d}, {lookup.num_songs} songs")
+        return SearchState(version, generator, index, lookup)
 
-                    seen_songs.add(song_info)
+    def current_version(self):
+        # Changes whenever the checkpoint is rewritten or an index release is published
+        return file_version(self.model_path), release_version(self.index_path, self.mapping_path, self.metadata_path)
 
-                    if "||" in song_info:
-                        title, artist = song_info.split("||", 1)
-                    else:
-                        title = song_info
-                        artist = "Unknown Artist"
+    def refresh(self):
+        # Picks up a new checkpoint or index release, at most once per refresh_interval.
+        # Checkpoints are replaced atomically and releases are complete once the pointer names
+        # them; flat files from before releases are only trusted once they stop changing.
+        if time.monotonic() < self._next_refresh:
+            return
+        with self._reload_lock:
+            if time.monotonic() < self._next_refresh:
+                return
+            self._next_refresh = time.monotonic() + self.refresh_interval
 
-                    max_distance = 1000.0
-                    confidence = max(0, min(100, (1 - match['distance'] / max_distance) * 100))
+            state = self.state
+            try:
+                version = self.current_version()
+            except OSError:
+                return
+            if version == state.version:
+                self._unsettled = None
+                return
+            if not isinstance(version[1], str) and version != self._unsettled:
+                self._unsettled = version
+                return
 
-                    formatted_results.append({
-                        "title": title.strip(),
-                        "artist": artist.strip(),
-                        "match": f"{confidence:.1f}%"
-                    })
+            try:
+                if version[0] != state.version[0]:
+                    print("Checkpoint changed, reloading model")
+                    self.state = self.load_state(version)
+                else:
+                    print("Index changed, reloading")
+                    self.state = self.load_state(version, state.generator)
+            except Exception as e:
+                print(f"Reload failed, still serving the previous version: {e}")
+                return
+            self._unsettled = None
+            self.cache.clear()
 
-            formatted_results.sort(key=lambda x: float(x['match'].strip('%')), reverse=True)
+    def search(self, audio, sr=None):
+        if isinstance(audio, str):
+            # Decoded straight to the mel rate, so prepare_audio has nothing left to resample
+            audio, sr = load_audio(audio, sr=MEL_SAMPLE_RATE)
+        elif sr is None:
+            raise ValueError("Sample rate is required when searching a waveform")
 
-            return formatted_results[:20]
+        audio = prepare_audio(audio, sr, target_sr=MEL_SAMPLE_RATE)
+        if audio is None:
+            return []
 
+        self.refresh()
+        state = self.state
+        # Keyed by the normalized PCM, so re-encoded copies of the same clip share an entry
+        key = (array_hash(audio), state.version, self.segment_mode, self.aggregate)
+        results = self.cache.get_or_compute(key, lambda: self._search_audio(state, audio))
+        return [dict(result) for result in results]
+
+    def _search_audio(self, state, audio):
+        spec = process_audio(audio, sr=MEL_SAMPLE_RATE)
+        if self.segment_mode:
+            tensor, _ = state.generator.segment(spec)
+        else:
+            tensor = state.generator.preprocess(spec)
+
+        matches = self.batcher.submit((state, tensor))
+        return format_results({'query': {'matches': matches}}, limit=self.top_k)
+
+    def _search_batch(self, items):
+        # Queries that straddle a reload run against the state they started with
+        groups = {}
+        for position, (state, tensor) in enumerate(items):
+            groups.setdefault(id(state), (state, []))[1].append(position)
+
+        results = [None] * len(items)
+        for state, positions in groups.values():
+            tensors = [items[position][1] for position in positions]
+            for position, result in zip(positions, self._search_state(state, tensors)):
+                results[position] = result
+        return results
+
+    def _search_state(self, state, tensors):
+        embeddings = state.generator.generate_embeddings(tensors)
+
+        if self.segment_mode:
+            bounds = np.cumsum([tensor.shape[0] for tensor in tensors])[:-1]
+            return search_segments_batch(state.index, None, None, None, np.split(embeddings, bounds),
+                                         k=self.top_k, aggregate=self.aggregate, lookup=state.lookup)
+        return search_embeddings(state.index, None, None, embeddings, k=self.top_k, lookup=state.lookup)
+
+    def search_files(self, input_file):
+        with self._lock:
+            cleanup_search_directories()
+            setup_search_directories()
+
+            copy_input_file(input_file)
+
+            state = self.state
+            search_1('search', 'search')
+            search_2('search', 'search', self.model_path, generator=state.generator)
+            search_results = search_3('search', 'search', state.index, k=self.top_k, lookup=state.lookup)
+
+        return format_results(search_results, limit=self.top_k)
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_search_engine():
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = SearchEngine()
+    return _engine
+
+def run_search_pipeline(input_file, in_memory=True):
+    try:
+        engine = get_search_engine()
+        if in_memory:
+            return engine.search(input_file)
+        return engine.search_files(input_file)
     except Exception as e:
         raise Exception(f"Search pipeline error: {str(e)}")
-
-    return []
@@ -8,11 +8,7 @@ import librosa
 from tqdm import tqdm
 
 def process_batch(generator, batch_tensors):
-    embeddings = []
-    for tensor in batch_tensors:
-        embedding = generator.generate_embedding(tensor)
-        embeddings.append(embedding)
-    return np.vstack(embeddings)
+    return generator.generate_embeddings(batch_tensors)
 
 def process_audio_to_mel(audio, sr=22050, n_mels=80, n_fft=1024, hop_length=256,
                         win_length=1024, fmin=0.0, fmax=8000.0):
@@ -20,7 +16,7 @@ def process_audio_to_mel(audio, sr=22050, n_mels=80, n_fft=1024, hop_length=256,
                       hop_length=hop_length, win_length=win_length,
                       fmin=fmin, fmax=fmax)
 
-def search_2(input_folder, output_folder, model_path):
+def search_2(input_folder, output_folder, model_path, generator=None):
     config = Config()
     print(f"Using model configuration:")
     print(f"- Input shape: {config.input_shape}")
@@ -31,8 +27,9 @@ def search_2(input_folder, output_folder, model_path):
     output_folder = os.path.join(output_folder, "embedding")
     os.makedirs(output_folder, exist_ok=True)
 
-    print("Initializing embedding generator...")
-    generator = EmbeddingGenerator(model_path)
+    if generator is None:
+        print("Initializing embedding generator...")
+        generator = EmbeddingGenerator(model_path)
 
     audio_files = [f for f in os.listdir(input_folder) if f.endswith('.mp3')]
     valid_files = [f for f in audio_files if os.path.exists(os.path.join(input_folder, f))]
@@ -4,6 +4,8 @@ import os
 import json
 import csv
 from tqdm import tqdm
+from metadata_store import MetadataStore
+from index_release import load_release
 
 def validate_and_reshape_embedding(embedding, expected_dim=512):
     if not isinstance(embedding, np.ndarray):
@@ -23,18 +25,17 @@ def validate_and_reshape_embedding(embedding, expected_dim=512):
 
     return embedding
 
-def search_3(input_folder, output_folder):
-    query_folder = os.path.join(input_folder, "embedding")
-    results_folder = os.path.join(output_folder, "results")
-    os.makedirs(results_folder, exist_ok=True)
-
-    skipped_files = []
+INDEX_PATH = os.path.join("output", "output8", "song_index.faiss")
+MAPPING_PATH = os.path.join("output", "output8", "index_mapping.json")
+METADATA_PATH = os.path.join("output", "output7", "metadata.csv")
+SEGMENT_INDEX_PATH = os.path.join("output", "output8", "segment_index.faiss")
+SEGMENT_MAPPING_PATH = os.path.join("output", "output8", "segment_mapping.json")
+SEGMENT_METADATA_PATH = os.path.join("output", "output7", "segment_metadata.csv")
 
+def load_search_index(index_path=INDEX_PATH, mapping_path=MAPPING_PATH, metadata_path=METADATA_PATH):
+    release = load_release(index_path, mapping_path, metadata_path)
+    index_path, mapping_path, metadata_path = release.index_path, release.mapping_path, release.metadata_path
     try:
-        index_path = os.path.join("output", "output8", "song_index.faiss")
-        mapping_path = os.path.join("output", "output8", "index_mapping.json")
-        metadata_path = os.path.join("output", "output7", "metadata.csv")
-
         print(f"Loading index from: {index_path}")
         index = faiss.read_index(index_path)
         print(f"Loading mappings from: {mapping_path}")
@@ -46,10 +47,151 @@ def search_3(input_folder, output_folder):
     except Exception as e:
         raise RuntimeError(f"Failed to load required files: {e}")
 
+    return index, index_to_id, metadata
+
+def unique_top_k(positions, distances, k):
+    # First (best) hit of each song, in distance order
+    valid = np.flatnonzero(positions >= 0)
+    _, first = np.unique(positions[valid], return_index=True)
+    keep = valid[np.sort(first)][:k]
+    return positions[keep], distances[keep]
+
+def format_matches(lookup, rows, distances, offsets=None, scores=None):
+    # Strings are read from the lookup's tables for the final rows only
+    columns = {name: lookup.column(name, rows) for name in ('id', 'song', 'info', 'title', 'artist')}
+    matches = []
+    for rank, distance in enumerate(np.asarray(distances, dtype=np.float64).tolist(), 1):
+        match = {
+            'rank': rank,
+            'song_id': columns['id'][rank - 1],
+            'song_name': columns['song'][rank - 1],
+            'info': columns['info'][rank - 1],
+            'title': columns['title'][rank - 1],
+            'artist': columns['artist'][rank - 1],
+            'distance': distance
+        }
+        if offsets is not None:
+            match['offset'] = offsets[rank - 1]
+        if scores is not None:
+            match['score'] = scores[rank - 1]
+        matches.append(match)
+    return matches
+
+def adaptive_search(index, queries, k, fetch, select):
+    # Over-fetch until select(query_row, indices, distances) yields k songs or the index is exhausted.
+    # Only the queries still short of k are searched again, with a larger fetch.
+    results = [None] * len(queries)
+    pending = np.arange(len(queries))
+    fetch = max(1, min(fetch, index.ntotal))
+
+    while len(pending):
+        distances, indices = index.search(queries[pending], fetch)
+        short = []
+        for row, query in enumerate(pending):
+            results[query] = select(query, indices[row], distances[row])
+            if len(results[query][0]) < k and fetch < index.ntotal:
+                short.append(query)
+        pending = np.array(short, dtype=np.int64)
+        fetch = min(fetch * 4, index.ntotal)
+
+    return results
+
+def search_embeddings(index, index_to_id, metadata, query_embeddings, k=10, lookup=None, fetch_factor=2):
+    # One index.search for a batch of queries; each query gets up to k distinct songs
+    lookup = lookup or MetadataStore.from_mappings(index_to_id, metadata)
+    queries = np.ascontiguousarray(np.asarray(query_embeddings, dtype=np.float32).reshape(-1, index.d))
+    if len(queries) == 0 or index.ntotal == 0:
+        return [[] for _ in queries]
+
+    def select(query, indices, distances):
+        return unique_top_k(lookup.resolve(indices), distances, k)
+
+    return [format_matches(lookup, positions, distances)
+            for positions, distances in adaptive_search(index, queries, k, k * fetch_factor, select)]
+
+def search_embedding(index, index_to_id, metadata, query_embedding, k=10, lookup=None):
+    query_embedding = validate_and_reshape_embedding(query_embedding)
+    return search_embeddings(index, index_to_id, metadata, query_embedding, k, lookup)[0]
+
+def aggregate_segments(positions, distances, k=10, aggregate='max'):
+    # Per-song score from all segment hits; also the closest hit's distance and vector row
+    flat = positions.ravel()
+    valid = np.flatnonzero(flat >= 0)
+    if len(valid) == 0:
+        return flat[:0], distances.ravel()[:0], valid, distances.ravel()[:0]
+
+    songs, group = np.unique(flat[valid], return_inverse=True)
+    distance = distances.ravel()[valid].astype(np.float64)
+    similarity = 1.0 / (1.0 + distance)
+
+    scores = np.zeros(len(songs))
+    if aggregate == 'sum':
+        np.add.at(scores, group, similarity)
+    else:
+        np.maximum.at(scores, group, similarity)
+
+    # Closest hit per song: sort by (song, distance) and take each group's first entry
+    order = np.lexsort((distance, group))
+    starts = np.flatnonzero(np.r_[True, group[order][1:] != group[order][:-1]])
+    best = order[starts]
+
+    top = np.argsort(-scores, kind='stable')[:k]
+    return songs[top], distance[best][top], valid[best][top], scores[top]
+
+def search_segments_batch(index, index_to_id, metadata, offsets, queries, k=10,
+                          aggregate='max', fetch_factor=10, lookup=None):
+    # queries: one (segments, d) array per query; segments of all queries are searched together
+    lookup = lookup or MetadataStore.from_mappings(index_to_id, metadata, offsets)
+    queries = [np.asarray(q, dtype=np.float32).reshape(-1, index.d) for q in queries]
+    if not queries:
+        return []
+    if index.ntotal == 0:
+        return [[] for _ in queries]
+
+    stacked = np.ascontiguousarray(np.concatenate(queries))
+    bounds = np.cumsum([0] + [len(q) for q in queries])
+    fetch = max(1, min(k * fetch_factor, index.ntotal))
+    distances, indices = index.search(stacked, fetch)
+
+    results = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        query_indices, query_distances = indices[start:end], distances[start:end]
+        query_fetch = fetch
+        while True:
+            songs, best_distances, best_hits, scores = aggregate_segments(
+                lookup.resolve(query_indices), query_distances, k, aggregate)
+            if len(songs) >= k or query_fetch >= index.ntotal:
+                break
+            # Too few distinct songs among the hits: widen this query's search
+            query_fetch = min(query_fetch * 4, index.ntotal)
+            query_distances, query_indices = index.search(stacked[start:end], query_fetch)
+
+        hit_ids = query_indices.ravel()[best_hits]
+        offsets = np.round(lookup.segment_offsets[hit_ids].astype(np.float64), 3).tolist()
+        results.append(format_matches(lookup, songs, best_distances, offsets=offsets, scores=scores.tolist()))
+    return results
+
+def search_segments(index, index_to_id, metadata, offsets, query_embeddings, k=10,
+                    aggregate='max', fetch_factor=10, lookup=None):
+    # Many vectors per song: over-fetch segments, then score each song by its hits
+    return search_segments_batch(index, index_to_id, metadata, offsets, [query_embeddings], k,
+                                 aggregate, fetch_factor, lookup)[0]
+
+def search_3(input_folder, output_folder, index=None, index_to_id=None, metadata=None, k=10, lookup=None):
+    query_folder = os.path.join(input_folder, "embedding")
+    results_folder = os.path.join(output_folder, "results")
+    os.makedirs(results_folder, exist_ok=True)
+
+    skipped_files = []
+
+    if index is None or (lookup is None and (index_to_id is None or metadata is None)):
+        index, index_to_id, metadata = load_search_index()
+
     query_files = [f for f in os.listdir(query_folder) if f.endswith('_embedding.npy')]
-    results = {}
+    query_names = []
+    query_embeddings = []
 
-    for query_file in tqdm(query_files, desc="Processing queries"):
+    for query_file in tqdm(query_files, desc="Loading queries"):
         try:
             query_path = os.path.join(query_folder, query_file)
             query_embedding = np.load(query_path)
@@ -59,33 +201,20 @@ def search_3(input_folder, output_folder):
             query_embedding = validate_and_reshape_embedding(query_embedding)
             print(f"Reshaped query shape: {query_embedding.shape}")
 
-            distances, indices = index.search(query_embedding.astype(np.float32), 10)
-            print(f"Search results shape - distances: {distances.shape}, indices: {indices.shape}")
-
-            query_results = []
-            for rank, (idx, distance) in enumerate(zip(indices[0], distances[0]), 1):
-                if idx == -1:
-                    continue
-
-                song_id = index_to_id[idx]
-                query_results.append({
-                    'rank': rank,
-                    'song_id': song_id,
-                    'song_name': metadata[song_id]['song'],
-                    'info': metadata[song_id]['info'],
-                    'distance': float(distance)
-                })
-
-            query_name = os.path.splitext(query_file)[0].replace('_embedding', '')
-            results[query_name] = {
-                'matches': query_results
-            }
+            query_names.append(os.path.splitext(query_file)[0].replace('_embedding', ''))
+            query_embeddings.append(query_embedding)
 
         except Exception as e:
             print(f"\nError processing {query_file}: {str(e)}")
             skipped_files.append({'file': query_file, 'error': str(e)})
             continue
 
+    # All queries in one index.search
+    results = {}
+    if query_embeddings:
+        matches = search_embeddings(index, index_to_id, metadata, np.vstack(query_embeddings), k, lookup)
+        results = {name: {'matches': query_matches} for name, query_matches in zip(query_names, matches)}
+
     results_path = os.path.join(results_folder, "search_results.json")
     error_path = os.path.join(results_folder, "search_errors.json")
 
@@ -107,7 +236,8 @@ def load_mappings(mapping_path):
             mappings = json.load(f)
             if 'metadata' not in mappings:
                 raise ValueError("Missing metadata in mapping file")
-            return {int(k): v['id'] for k, v in mappings['metadata'].items()}
+            deleted = set(mappings.get('deleted', []))
+            return {int(k): v['id'] for k, v in mappings['metadata'].items() if int(k) not in deleted}
         except json.JSONDecodeError:
             raise ValueError("Invalid JSON format in mapping file")
 
@@ -0,0 +1,141 @@
+import os
+import csv
+import json
+import numpy as np
+from tqdm import tqdm
+
+class SpectrogramShardWriter:
+    # Packs (n_mels, frames) spectrograms into a few large shard files.
+    # Frames are stored time-major so cropping the first N frames reads one contiguous range.
+    FIELDNAMES = ['key', 'shard', 'offset', 'n_mels', 'frames']
+
+    def __init__(self, folder, dtype='float16', shard_size_bytes=1 << 30):
+        self.folder = folder
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.float32, np.float16):
+            raise ValueError(f"Unsupported spectrogram dtype: {self.dtype}")
+        self.shard_size_bytes = shard_size_bytes
+        self.entries = []
+        self._shard = -1
+        self._file = None
+        os.makedirs(folder, exist_ok=True)
+
+    def _shard_path(self, shard):
+        return os.path.join(self.folder, f"shard_{shard:05d}.bin")
+
+    def _next_shard(self):
+        if self._file is not None:
+            self._file.close()
+        self._shard += 1
+        self._file = open(self._shard_path(self._shard), 'wb')
+
+    def add(self, key, spec):
+        spec = np.asarray(spec)
+        if spec.ndim != 2:
+            raise ValueError(f"Expected 2D array, got shape {spec.shape}")
+
+        data = np.ascontiguousarray(spec.T, dtype=self.dtype).tobytes()
+        if self._file is None or (self._file.tell() and self._file.tell() + len(data) > self.shard_size_bytes):
+            self._next_shard()
+
+        self.entries.append({'key': key, 'shard': self._shard, 'offset': self._file.tell(),
+                             'n_mels': spec.shape[0], 'frames': spec.shape[1]})
+        self._file.write(data)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        with open(os.path.join(self.folder, "index.csv"), 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=self.FIELDNAMES)
+            writer.writeheader()
+            writer.writerows(self.entries)
+        with open(os.path.join(self.folder, "store.json"), 'w', encoding='utf-8') as f:
+            json.dump({'dtype': self.dtype.name, 'num_shards': self._shard + 1}, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+class SpectrogramShardReader:
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, "store.json"), 'r', encoding='utf-8') as f:
+            header = json.load(f)
+        self.dtype = np.dtype(header['dtype'])
+        self.num_shards = header['num_shards']
+
+        self.index = {}
+        with open(os.path.join(folder, "index.csv"), newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                self.index[row['key']] = (int(row['shard']), int(row['offset']),
+                                          int(row['n_mels']), int(row['frames']))
+        self._maps = {}
+
+    def __getstate__(self):
+        # Memory maps are reopened lazily in each DataLoader worker
+        state = self.__dict__.copy()
+        state['_maps'] = {}
+        return state
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def _shard_map(self, shard):
+        shard_map = self._maps.get(shard)
+        if shard_map is None:
+            path = os.path.join(self.folder, f"shard_{shard:05d}.bin")
+            shard_map = self._maps[shard] = np.memmap(path, dtype=np.uint8, mode='r')
+        return shard_map
+
+    def get(self, key):
+        # Zero-copy (n_mels, frames) view into the shard
+        shard, offset, n_mels, frames = self.index[key]
+        data = np.ndarray((frames, n_mels), dtype=self.dtype, buffer=self._shard_map(shard), offset=offset)
+        return data.T
+
+    @staticmethod
+    def exists(folder):
+        return os.path.exists(os.path.join(folder, "store.json"))
+
+def convert_directory(src_dir, dst_dir, dtype='float16', subdirs=('hum', 'song'), shard_size_bytes=1 << 30):
+    # Keys are the paths relative to src_dir, as used in train/val lists and metadata
+    files = []
+    for sub in subdirs:
+        sub_dir = os.path.join(src_dir, sub)
+        if os.path.isdir(sub_dir):
+            files.extend(f"{sub}/{name}" for name in sorted(os.listdir(sub_dir)) if name.endswith('.npy'))
+
+    failed = 0
+    with SpectrogramShardWriter(dst_dir, dtype=dtype, shard_size_bytes=shard_size_bytes) as writer:
+        for key in tqdm(files, desc="Packing spectrograms"):
+            try:
+                writer.add(key, np.load(os.path.join(src_dir, key)))
+            except Exception as e:
+                print(f"Error packing {key}: {e}")
+                failed += 1
+
+    print(f"Packed {len(files) - failed} spectrograms into {dst_dir}")
+    if failed:
+        print(f"Failed to pack {failed} files")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Pack a directory of .npy spectrograms into shards")
+    parser.add_argument("src_dir", help="e.g. output/output3")
+    parser.add_argument("dst_dir", help="e.g. output/output3_shards")
+    parser.add_argument("--dtype", choices=["float16", "float32"], default="float16")
+    parser.add_argument("--shard-size-mb", type=int, default=1024)
+    args = parser.parse_args()
+
+    convert_directory(args.src_dir, args.dst_dir, dtype=args.dtype, shard_size_bytes=args.shard_size_mb << 20)
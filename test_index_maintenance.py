@@ -0,0 +1,61 @@
+import os
+import csv
+import json
+import numpy as np
+import torch
+from train_model_3 import ResNetFace
+from embedding_store import EmbeddingStore
+from index_release import load_release
+from index_maintenance import IndexMaintainer
+from inference_2 import process_inference_data
+from inference_3 import build_index
+
+def make_catalog(root, num_songs=5):
+    torch.manual_seed(0)
+    model_path = os.path.join(root, "model.pth")
+    torch.save(ResNetFace(feature_dim=512).state_dict(), model_path)
+
+    rng = np.random.default_rng(0)
+    os.makedirs(os.path.join(root, "output6", "song"))
+    with open(os.path.join(root, "output6", "metadata.csv"), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['id', 'song', 'info'])
+        for i in range(num_songs):
+            writer.writerow([str(i), f"song{i}.npy", f"Title {i}||Artist {i}"])
+            np.save(os.path.join(root, "output6", "song", f"song{i}.npy"),
+                    rng.standard_normal((80, 200 + 10 * i)).astype(np.float32))
+    return model_path
+
+def open_maintainer(root):
+    output8 = os.path.join(root, "output8")
+    return IndexMaintainer(os.path.join(output8, "song_index.faiss"), os.path.join(output8, "index_mapping.json"),
+                           os.path.join(root, "output7", "metadata.csv"))
+
+def indexed_ids(root):
+    output8 = os.path.join(root, "output8")
+    release = load_release(os.path.join(output8, "song_index.faiss"), None, None)
+    with open(release.mapping_path, 'r', encoding='utf-8') as f:
+        return [entry['id'] for entry in json.load(f)['metadata'].values()]
+
+def test_rebuild_keeps_maintenance_edits(tmp_path):
+    root = str(tmp_path)
+    model_path = make_catalog(root)
+    process_inference_data(root, root, model_path)
+    build_index(root, root)
+
+    maintainer = open_maintainer(root)
+    maintainer.remove_songs(['0', '1'])
+    # An update stored under another file stem than the catalog's own entry for the song
+    maintainer.add_songs([('2', 'replacement_embedding', 'New||Artist', np.ones((1, 512), dtype=np.float32), None)])
+    maintainer.save()
+
+    process_inference_data(root, root, model_path)
+    build_index(root, root)
+
+    ids = indexed_ids(root)
+    assert sorted(ids) == ['2', '3', '4']
+    store = EmbeddingStore(os.path.join(root, "output7"))
+    assert sorted(entry['id'] for entry in store.entries) == ['2', '3', '4']
+    assert [entry['song'] for entry in store.entries if entry['id'] == '2'] == ['replacement_embedding']
+    with open(os.path.join(root, "output7", "metadata.csv"), newline='', encoding='utf-8') as f:
+        assert sorted(row['id'] for row in csv.DictReader(f)) == ['2', '3', '4']
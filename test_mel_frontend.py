@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from benchmark import random_clips, reference_process_audio
+from process_audio_3 import MelFrontend
+
+def test_single_clip_matches_reference():
+    frontend = MelFrontend()
+    clip = random_clips(1, 1.0, 3.0)[0]
+    np.testing.assert_allclose(frontend(clip), reference_process_audio(clip), atol=1e-4)
+
+def test_batch_matches_reference_per_clip():
+    # Mixed lengths, including one just past the reflect-padding limit
+    frontend = MelFrontend()
+    clips = random_clips(6, 0.1, 4.0) + [np.random.default_rng(0).standard_normal(513).astype(np.float32)]
+    for clip, spec in zip(clips, frontend.process_batch(clips)):
+        expected = reference_process_audio(clip)
+        assert spec.shape == expected.shape
+        np.testing.assert_allclose(spec, expected, atol=1e-4)
+
+def test_padded_batch_ignores_samples_past_each_length():
+    frontend = MelFrontend()
+    clips = random_clips(4, 0.5, 2.0)
+    lengths = [len(clip) for clip in clips]
+    padded = np.random.default_rng(1).standard_normal((len(clips), max(lengths))).astype(np.float32)
+    for row, clip in enumerate(clips):
+        padded[row, :len(clip)] = clip
+
+    for clip, spec in zip(clips, frontend.process_batch(padded, lengths)):
+        np.testing.assert_allclose(spec, reference_process_audio(clip), atol=1e-4)
+
+def test_empty_batch():
+    assert MelFrontend().process_batch([]) == []
+
+def test_clip_too_short_for_reflect_padding():
+    with pytest.raises(ValueError):
+        MelFrontend().process_batch([np.zeros(512, dtype=np.float32)])
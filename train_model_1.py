@@ -0,0 +1,246 @@
+import os
+import contextlib
+import time
+import random
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, DistributedSampler
+from logger import logger
+from train_model_3 import ResNetFace, ArcMarginProduct, FocalLoss, AudioDataset, read_val, calculate_mrr
+
+STATE_FILE = 'train_state.pth'
+BEST_FILE = 'resnetface_best.pth'
+
+class ResumableSampler(DistributedSampler):
+    # This rank's shard of a seeded per-epoch permutation, able to start part-way through so a
+    # resumed epoch sees exactly the samples an uninterrupted run would have seen next
+    def __init__(self, dataset, num_replicas=1, rank=0, seed=0):
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=True, seed=seed)
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        super().set_epoch(epoch)
+        self.start = start
+
+    def __iter__(self):
+        return iter(list(super().__iter__())[self.start:])
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+class TrainingModel(nn.Module):
+    # Backbone and margin head as one module, so DDP syncs both in a single all-reduce
+    def __init__(self, backbone, metric_fc, bf16=False):
+        super().__init__()
+        self.backbone = backbone
+        self.metric_fc = metric_fc
+        self.bf16 = bf16
+
+    def forward(self, data, label):
+        with torch.autocast(device_type=data.device.type, dtype=torch.bfloat16, enabled=self.bf16):
+            feature = self.backbone(data)
+        # Margin head stays float32: the angular margin is sensitive to rounding
+        return self.metric_fc(feature.float(), label)
+
+def init_distributed(opt):
+    # Launched by torchrun (RANK/WORLD_SIZE/LOCAL_WORLD_SIZE in the environment); a plain
+    # python launch trains in a single process
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 1
+    dist.init_process_group(backend=opt.dist_backend)
+    # Split the cores between the processes on this node instead of every rank using all of them
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+    threads = opt.threads_per_process or max(1, (os.cpu_count() or 1) // local_world_size)
+    torch.set_num_threads(threads)
+    return dist.get_rank(), world_size
+
+def rng_state():
+    return {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+    if state.get('cuda') is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def save_checkpoint(path, state):
+    # Written next to the target and renamed, so a crash mid-save keeps the previous checkpoint
+    tmp_path = f"{path}.tmp"
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+def train_model_1(opt):
+    rank, world_size = init_distributed(opt)
+    distributed = world_size > 1
+    if distributed and opt.dist_backend == 'nccl':
+        device = torch.device("cuda", int(os.environ.get('LOCAL_RANK', 0)))
+        torch.cuda.set_device(device)
+    elif distributed:
+        device = torch.device("cpu")
+    else:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # Dropout streams differ per rank; DDP copies rank 0's initial weights to the others
+    torch.manual_seed(opt.seed + rank)
+    np.random.seed(opt.seed + rank)
+    random.seed(opt.seed + rank)
+
+    # Each rank holds its own in-memory copy, so the ranks on a node share its memory
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size)) if distributed else 1
+    dataset = AudioDataset(opt.train_root, opt.train_list, opt.input_shape, shard_dir=opt.train_shards,
+                           in_memory=opt.train_in_memory, processes_per_node=local_world_size)
+    num_classes = max(label for _, label in dataset.samples)
+    sampler = ResumableSampler(dataset, world_size, rank, opt.seed)
+    # A private generator keeps DataLoader worker seeding from consuming the global RNG,
+    # which dropout draws from and which is restored on resume
+    loader = DataLoader(dataset, batch_size=opt.train_batch_size, sampler=sampler, num_workers=opt.num_workers,
+                        pin_memory=device.type == 'cuda', persistent_workers=False,
+                        prefetch_factor=4 if opt.num_workers > 0 else None, generator=torch.Generator())
+    data_val = read_val(opt.val_list, opt.train_root) if os.path.exists(opt.val_list) else []
+
+    model = ResNetFace(feature_dim=opt.embedding_dim).to(device)
+    metric_fc = ArcMarginProduct(opt.embedding_dim, num_classes, s=opt.metric_scale, m=opt.metric_margin,
+                                 easy_margin=opt.easy_margin).to(device)
+    if opt.channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    criterion = FocalLoss(gamma=2)
+    optimizer = torch.optim.Adam([{'params': model.parameters()}, {'params': metric_fc.parameters()}],
+                                 lr=opt.lr, weight_decay=opt.weight_decay)
+    scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=opt.lr_step, gamma=0.1)
+
+    # Checkpoints always hold the unwrapped model and metric_fc, so there is no 'module.' prefix
+    train_step = TrainingModel(model, metric_fc, opt.bf16)
+    if distributed:
+        train_step = DistributedDataParallel(train_step, device_ids=[device.index] if device.type == 'cuda' else None)
+
+    if rank == 0:
+        logger.info(f"Training on {world_size} x {device} ({torch.get_num_threads()} threads each): "
+                    f"{len(dataset)} samples, {num_classes} classes, batch {opt.train_batch_size} x "
+                    f"{opt.grad_accum_steps} accumulation steps x {world_size} ranks, "
+                    f"bf16: {opt.bf16}, channels_last: {opt.channels_last}")
+
+    state_path = os.path.join(opt.checkpoints_path, STATE_FILE)
+    epoch, batches_done, global_step, best_mrr = 0, 0, 0, -1.0
+    if opt.resume and os.path.exists(state_path):
+        state = torch.load(state_path, map_location=device, weights_only=False)
+        model.load_state_dict(state['model'])
+        metric_fc.load_state_dict(state['metric_fc'])
+        optimizer.load_state_dict(state['optimizer'])
+        scheduler.load_state_dict(state['scheduler'])
+        epoch, batches_done = state['epoch'], state['batches_done']
+        global_step, best_mrr = state['global_step'], state['best_mrr']
+        if state.get('world_size', 1) != world_size:
+            raise RuntimeError(f"Checkpoint was written by {state.get('world_size', 1)} processes, "
+                               f"resume with the same count (now {world_size})")
+        # Single-process train_state.pth files from before distributed training hold one RNG
+        # state rather than a list with one per rank
+        set_rng_state(state['rng'] if isinstance(state['rng'], dict) else state['rng'][rank])
+        if rank == 0:
+            logger.info(f"Resumed from {state_path}: epoch {epoch}, batch {batches_done}, step {global_step}")
+
+    def checkpoint():
+        rng = [rng_state()]
+        if distributed:
+            rng = [None] * world_size
+            dist.all_gather_object(rng, rng_state())
+        if rank == 0:
+            save_checkpoint(state_path, {
+                'model': model.state_dict(), 'metric_fc': metric_fc.state_dict(),
+                'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(),
+                'epoch': epoch, 'batches_done': batches_done, 'global_step': global_step,
+                'best_mrr': best_mrr, 'rng': rng, 'world_size': world_size, 'num_classes': num_classes
+            })
+        if distributed:
+            dist.barrier()
+
+    batches_per_epoch = -(-sampler.num_samples // opt.train_batch_size)
+    stop = False
+    while epoch < opt.max_epoch and not stop:
+        model.train()
+        metric_fc.train()
+        sampler.set_epoch(epoch, batches_done * opt.train_batch_size)
+        batches = iter(loader)
+
+        # Throughput window, reset every print_freq optimizer steps
+        window_start = time.perf_counter()
+        window_wait = 0.0
+        window_samples = 0
+        loss_sum = 0.0
+
+        while batches_done < batches_per_epoch:
+            # Gradients of up to grad_accum_steps batches make one optimizer step; the last
+            # group of an epoch may be shorter
+            group_size = min(opt.grad_accum_steps, batches_per_epoch - batches_done)
+            optimizer.zero_grad(set_to_none=True)
+            for micro_step in range(group_size):
+                wait_start = time.perf_counter()
+                data, label = next(batches)
+                window_wait += time.perf_counter() - wait_start
+
+                data = data.to(device, non_blocking=True)
+                label = label.to(device, non_blocking=True)
+                if opt.channels_last:
+                    data = data.contiguous(memory_format=torch.channels_last)
+
+                # Gradients are all-reduced once per optimizer step, on the group's last batch
+                sync = not distributed or micro_step == group_size - 1
+                with contextlib.nullcontext() if sync else train_step.no_sync():
+                    output = train_step(data, label)
+                    loss = criterion(output, label) / group_size
+                    loss.backward()
+
+                loss_sum += loss.item()
+                window_samples += data.shape[0]
+                batches_done += 1
+
+            optimizer.step()
+            global_step += 1
+
+            if global_step % opt.print_freq == 0 and rank == 0:
+                # Rank 0's window; every rank processes the same number of samples per step
+                elapsed = time.perf_counter() - window_start
+                logger.info(f"Epoch {epoch} step {global_step} ({batches_done}/{batches_per_epoch} batches) "
+                            f"loss {loss_sum / opt.print_freq:.4f} lr {optimizer.param_groups[0]['lr']:.2e} "
+                            f"{window_samples * world_size / elapsed:.1f} samples/s, "
+                            f"data wait {window_wait / elapsed:.1%}")
+                window_start = time.perf_counter()
+                window_wait = 0.0
+                window_samples = 0
+                loss_sum = 0.0
+
+            if opt.max_steps is not None and global_step >= opt.max_steps:
+                stop = True
+                break
+            if global_step % opt.checkpoint_every == 0:
+                checkpoint()
+
+        if batches_done >= batches_per_epoch:
+            scheduler.step()
+            if data_val:
+                # DDP syncs buffers at the start of each forward, so the last batch left every rank
+                # with its own BatchNorm running stats: take rank 0's, the ones that get saved
+                if distributed:
+                    for buffer in model.buffers():
+                        dist.broadcast(buffer, 0)
+                # Every rank embeds a shard and gets the same MRR over the whole validation set
+                mrr = calculate_mrr(model, data_val, opt.input_shape[1:], num_workers=opt.num_workers)
+                if mrr > best_mrr:
+                    best_mrr = mrr
+                    if rank == 0:
+                        save_checkpoint(os.path.join(opt.checkpoints_path, BEST_FILE), model.state_dict())
+                if rank == 0:
+                    logger.info(f"Epoch {epoch} validation MRR: {mrr:.4f} (best {best_mrr:.4f})")
+            epoch += 1
+            batches_done = 0
+        checkpoint()
+
+    if rank == 0:
+        logger.info(f"Training finished at epoch {epoch}, step {global_step}, best MRR {best_mrr:.4f}")
+    if distributed:
+        dist.destroy_process_group()
+    return best_mrr
@@ -61,14 +61,31 @@ class Config:
         self.lr = 5e-4
         self.weight_decay = 1e-4
         self.print_freq = 50
+        self.lr_step = 10
+        self.seed = 42
+        self.grad_accum_steps = 1  # Effective batch size is train_batch_size * grad_accum_steps
+        self.bf16 = False  # bf16 autocast for the backbone; pays off on CPUs with AVX512-BF16/AMX
+        self.channels_last = False
+        self.checkpoint_every = 500  # Optimizer steps between resumable checkpoints
+        self.resume = True
+        self.max_steps = None  # Stop after this many optimizer steps, e.g. for smoke runs
+        # Distributed training: launch with torchrun, e.g. torchrun --nproc_per_node=8 train_model_2.py
+        # (add --nnodes/--node_rank/--master_addr for several machines); batch sizes are per process
+        self.dist_backend = 'gloo'
+        self.threads_per_process = None  # Defaults to the node's cores divided by its processes
 
         # Model settings
         self.backbone = 'resnetface'
         self.input_shape = (1, 80, 630)
         self.embedding_dim = 512
+        self.metric_scale = 30.0
+        self.metric_margin = 0.5
+        self.easy_margin = False
 
         # Data settings
         self.train_root = 'output/output3'
+        self.train_shards = None  # e.g. 'output/output3_shards', see spectrogram_store.convert_directory
+        self.train_in_memory = False  # Pre-crop the training set into one shared-memory tensor, see AudioDataset
         self.train_list = 'checkpoints/train_list.txt'
         self.val_list = 'checkpoints/val_list.txt'
 
@@ -86,3 +103,6 @@ def main():
     logger.info("Starting model training...")
     from train_model_1 import train_model_1
     train_model_1(opt)
+
+if __name__ == "__main__":
+    main()
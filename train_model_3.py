@@ -1,11 +1,16 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.distributed as dist
 import numpy as np
 import os
-from torch.utils.data import Dataset
+import math
+import shutil
+from torch.utils.data import Dataset, DataLoader
+from tqdm import tqdm
 import faiss
 from logger import logger
+from spectrogram_store import SpectrogramShardReader
 
 class FocalLoss(nn.Module):
     def __init__(self, gamma=2, eps=1e-7):
@@ -19,6 +24,37 @@ class FocalLoss(nn.Module):
         focal_loss = ((1 - pt) ** self.gamma * ce_loss).mean()
         return focal_loss
 
+class ArcMarginProduct(nn.Module):
+    # Additive angular margin head: class logits s*cos(theta + m) for the true class, s*cos(theta) otherwise
+    def __init__(self, in_features, out_features, s=30.0, m=0.50, easy_margin=False):
+        super(ArcMarginProduct, self).__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.s = s
+        self.m = m
+        self.easy_margin = easy_margin
+        self.weight = nn.Parameter(torch.FloatTensor(out_features, in_features))
+        nn.init.xavier_uniform_(self.weight)
+
+        self.cos_m = math.cos(m)
+        self.sin_m = math.sin(m)
+        self.th = math.cos(math.pi - m)
+        self.mm = math.sin(math.pi - m) * m
+
+    def forward(self, input, label):
+        cosine = F.linear(F.normalize(input), F.normalize(self.weight))
+        sine = torch.sqrt((1.0 - torch.pow(cosine, 2)).clamp(0, 1))
+        phi = cosine * self.cos_m - sine * self.sin_m
+        if self.easy_margin:
+            phi = torch.where(cosine > 0, phi, cosine)
+        else:
+            phi = torch.where(cosine > self.th, phi, cosine - self.mm)
+
+        one_hot = torch.zeros_like(cosine)
+        one_hot.scatter_(1, label.view(-1, 1).long(), 1)
+        output = (one_hot * phi) + ((1.0 - one_hot) * cosine)
+        return output * self.s
+
 class IRBlock(nn.Module):
     def __init__(self, inplanes, planes, stride=1):
         super(IRBlock, self).__init__()
@@ -108,9 +144,34 @@ class ResNetFace(nn.Module):
 
         return x
 
+def available_memory():
+    # Bytes that can still be placed in shared memory: free RAM, capped by the /dev/shm
+    # tmpfs that backs torch shared tensors on Linux. None when it cannot be determined.
+    available = None
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        try:
+            available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (ValueError, OSError, AttributeError):
+            pass
+    if available is not None and os.path.isdir('/dev/shm'):
+        available = min(available, shutil.disk_usage('/dev/shm').free)
+    return available
+
 class AudioDataset(Dataset):
-    def __init__(self, root_dir, list_file, input_shape):
+    # in_memory=True validates and crops every spectrogram once into a single shared-memory
+    # tensor that DataLoader workers read in place. It falls back to loading from disk per
+    # access when the estimate exceeds memory_fraction of the available memory.
+    # processes_per_node is how many training processes on this machine each hold their own copy.
+    def __init__(self, root_dir, list_file, input_shape, shard_dir=None, in_memory=False, memory_fraction=0.8,
+                 processes_per_node=1):
         self.root_dir = root_dir
+        self.shards = SpectrogramShardReader(shard_dir) if shard_dir else None
         if isinstance(input_shape, tuple):
             self.input_shape = (input_shape[1], input_shape[2])
         else:
@@ -130,6 +191,13 @@ class AudioDataset(Dataset):
                     path = path.replace('\\', '/')
                     label = int(label_str)
 
+                    if self.shards is not None:
+                        if path not in self.shards:
+                            logger.warning(f"Spectrogram not found in shards: {path}")
+                            continue
+                        self.samples.append((path, label))
+                        continue
+
                     full_path = os.path.join(root_dir, path)
                     if not os.path.exists(full_path):
                         logger.warning(f"File not found: {full_path}")
@@ -144,36 +212,93 @@ class AudioDataset(Dataset):
 
         logger.info(f"Loaded {len(self.samples)} valid samples")
 
-    def __len__(self):
-        return len(self.samples)
-
-    def __getitem__(self, idx):
-        try:
-            npy_path, label = self.samples[idx]
+        self.data = None
+        self.labels = None
+        if in_memory:
+            self._load_into_memory(memory_fraction, processes_per_node)
+
+    def _load_into_memory(self, memory_fraction, processes_per_node=1):
+        sample_bytes = int(np.prod(self.input_shape)) * np.dtype(np.float32).itemsize
+        required = len(self.samples) * sample_bytes
+        available = available_memory()
+        if available is not None:
+            # Every process on the node loads the same dataset, so each gets an equal share
+            available //= processes_per_node
+        logger.info(f"In-memory dataset: {len(self.samples)} samples x {sample_bytes / 2**20:.2f} MiB = "
+                    f"{required / 2**30:.2f} GiB, available: "
+                    f"{'unknown' if available is None else f'{available / 2**30:.2f} GiB'}"
+                    f"{f' per process ({processes_per_node} on this node)' if processes_per_node > 1 else ''}")
+        if available is not None and required > available * memory_fraction:
+            logger.warning(f"Dataset does not fit in {memory_fraction:.0%} of available memory, loading from disk")
+            return
+
+        # Allocated shared up front and filled in place, so the dataset is never held twice
+        data = torch.empty((len(self.samples), 1) + self.input_shape, dtype=torch.float32).share_memory_()
+        labels = torch.empty(len(self.samples), dtype=torch.int64)
+        kept = []
+        for idx in tqdm(range(len(self.samples)), desc="Loading spectrograms into memory"):
+            try:
+                sample, label = self._load_sample(idx)
+            except Exception as e:
+                logger.error(f"Dropping sample {idx} ({self.samples[idx][0]}): {e}")
+                continue
+            data[len(kept), 0] = torch.from_numpy(sample)
+            labels[len(kept)] = label
+            kept.append(self.samples[idx])
+
+        if len(kept) < len(self.samples):
+            logger.warning(f"Dropped {len(self.samples) - len(kept)} invalid samples")
+            if not kept:
+                raise RuntimeError("No valid samples found in the dataset")
+            # Slicing keeps the shared storage; the tail rows are unused
+            data = data[:len(kept)]
+            labels = labels[:len(kept)]
+        self.samples = kept
+        self.data = data
+        self.labels = labels.share_memory_()
+
+    def _load_sample(self, idx):
+        # Validated, cropped/padded float32 sample and zero-based label; raises on bad input
+        npy_path, label = self.samples[idx]
+        if self.shards is not None:
+            data = self.shards.get(npy_path)
+        else:
             data = np.load(npy_path)
 
-            if len(data.shape) != 2:
-                raise ValueError(f"Expected 2D array, got shape {data.shape}")
+        if len(data.shape) != 2:
+            raise ValueError(f"Expected 2D array, got shape {data.shape}")
+
+        if data.shape[1] >= self.input_shape[1]:
+            data = np.ascontiguousarray(data[:, :self.input_shape[1]], dtype=np.float32)
+        else:
+            result = np.zeros(self.input_shape, dtype=np.float32)
+            result[:, :data.shape[1]] = data
+            data = result
 
-            if data.shape[1] >= self.input_shape[1]:
-                data = data[:, :self.input_shape[1]]
-            else:
-                result = np.zeros(self.input_shape, dtype=np.float32)
-                result[:, :data.shape[1]] = data
-                data = result
+        if label <= 0:
+            raise ValueError(f"Invalid label value: {label}")
 
-            if label <= 0:
-                raise ValueError(f"Invalid label value: {label}")
+        label = label - 1
 
-            label = label - 1
+        if np.isnan(data).any() or np.isinf(data).any():
+            raise ValueError("Data contains NaN or Inf values")
 
-            if np.isnan(data).any() or np.isinf(data).any():
-                raise ValueError("Data contains NaN or Inf values")
+        return data, label
 
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, idx):
+        if self.data is not None:
+            # Samples were validated at startup; indexing the shared tensor copies nothing
+            return self.data[idx], int(self.labels[idx])
+
+        try:
+            data, label = self._load_sample(idx)
             return torch.from_numpy(data).float().unsqueeze(0), label
 
         except Exception as e:
-            logger.error(f"Error loading sample {idx} from {npy_path}: {e}")
+            logger.error(f"Error loading sample {idx} from {self.samples[idx][0]}: {e}")
             return torch.zeros((1,) + self.input_shape), 0
 
 def read_val(path_val, data_root):
@@ -193,54 +318,88 @@ def read_val(path_val, data_root):
             })
     return dict_data
 
-def calculate_mrr(model, data_val, input_shape):
-    model.eval()
-    device = next(model.parameters()).device
+def fit_input(data, input_shape):
+    # First input_shape[1] frames, zero-padded when the mel is shorter
+    if data.shape[1] >= input_shape[1]:
+        return data[:, :input_shape[1]]
+    result = np.zeros(input_shape, dtype=np.float32)
+    result[:, :data.shape[1]] = data
+    return result
+
+def retrieval_metrics(song_features, song_ids, hum_features, hum_ids, k=10, recall_at=(1, 5, 10)):
+    index = faiss.IndexFlatL2(song_features.shape[1])
+    index.add(np.ascontiguousarray(song_features, dtype=np.float32))
+    distances, indices = index.search(np.ascontiguousarray(hum_features, dtype=np.float32), k)
+
+    # hits[i, r]: the song at rank r is the right one for query i (-1 marks missing results)
+    song_ids = np.asarray(song_ids)
+    hum_ids = np.asarray(hum_ids)
+    hits = (indices >= 0) & (song_ids[np.maximum(indices, 0)] == hum_ids[:, None])
+    found = hits.any(axis=1)
+    first_rank = hits.argmax(axis=1)
+
+    metrics = {'mrr': float(np.mean(np.where(found, 1.0 / (first_rank + 1), 0.0)))}
+    for at in recall_at:
+        if at <= k:
+            metrics[f'recall@{at}'] = float(np.mean(hits[:, :at].any(axis=1)))
+    return metrics
+
+def mrr_from_features(song_features, song_ids, hum_features, hum_ids, k=10):
+    return retrieval_metrics(song_features, song_ids, hum_features, hum_ids, k)['mrr']
+
+class ValDataset(Dataset):
+    def __init__(self, data_val, input_shape):
+        self.paths = [item['path'] for item in data_val]
+        self.input_shape = input_shape
 
-    feature_dim = model.module.fc.out_features if hasattr(model, 'module') else model.fc.out_features
-    index = faiss.IndexFlatL2(feature_dim)
+    def __len__(self):
+        return len(self.paths)
 
-    song_features = []
-    song_ids = []
-    hum_features = []
-    hum_ids = []
+    def __getitem__(self, idx):
+        data = fit_input(np.load(self.paths[idx]), self.input_shape)
+        return torch.from_numpy(np.ascontiguousarray(data, dtype=np.float32)).unsqueeze(0)
 
+def embed_val(model, data_val, input_shape, batch_size=64, num_workers=2):
+    # Validation mels in file order through a prefetching DataLoader, embedded in large batches
+    device = next(model.parameters()).device
+    loader = DataLoader(ValDataset(data_val, input_shape), batch_size=batch_size, num_workers=num_workers,
+                        prefetch_factor=4 if num_workers > 0 else None, pin_memory=device.type == 'cuda')
+    features = []
     with torch.no_grad():
-        for item in data_val:
-            data = np.load(item['path'])
-            if data.shape[1] >= input_shape[1]:
-                data = data[:, :input_shape[1]]
-            else:
-                result = np.zeros(input_shape, dtype=np.float32)
-                result[:, :data.shape[1]] = data
-                data = result
-
-            tensor = torch.from_numpy(data).float().unsqueeze(0).unsqueeze(0).to(device)
-            feature = model(tensor).cpu().numpy()
-
-            if item['type'] == 'song':
-                song_features.append(feature)
-                song_ids.append(item['id'])
-            else:
-                hum_features.append(feature)
-                hum_ids.append(item['id'])
-
-    if not song_features or not hum_features:
-        return 0.0
+        for batch in loader:
+            features.append(model(batch.to(device, non_blocking=True)).float().cpu().numpy())
+    return np.vstack(features)
 
-    index.add(np.vstack(song_features))
-    hum_features = np.vstack(hum_features)
-
-    mrr_sum = 0
-    distances, indices = index.search(hum_features, 10)
+def calculate_mrr(model, data_val, input_shape, batch_size=64, num_workers=2, k=10):
+    model.eval()
 
-    for i, query_id in enumerate(hum_ids):
-        for rank, idx in enumerate(indices[i]):
-            if song_ids[idx] == query_id:
-                mrr_sum += 1.0 / (rank + 1)
-                break
+    is_song = np.array([item['type'] == 'song' for item in data_val], dtype=bool)
+    if not is_song.any() or is_song.all():
+        return 0.0
 
-    mrr = mrr_sum / len(hum_ids)
+    if dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+        # Each rank embeds every world_size-th item; all ranks then score the full set
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+        positions = np.arange(rank, len(data_val), world_size)
+        shard = embed_val(model, [data_val[i] for i in positions], input_shape, batch_size, num_workers) \
+            if len(positions) else None
+        gathered = [None] * world_size
+        dist.all_gather_object(gathered, (positions, shard))
+        dim = next(features.shape[1] for _, features in gathered if features is not None)
+        features = np.empty((len(data_val), dim), dtype=np.float32)
+        for positions, shard in gathered:
+            if shard is not None:
+                features[positions] = shard
+    else:
+        features = embed_val(model, data_val, input_shape, batch_size, num_workers)
+    ids = np.array([item['id'] for item in data_val])
+    song_ids = ids[is_song]
+    hum_ids = ids[~is_song]
+
+    metrics = retrieval_metrics(features[is_song], song_ids, features[~is_song], hum_ids, k)
+    mrr = metrics['mrr']
+    if dist.is_available() and dist.is_initialized() and dist.get_rank() != 0:
+        return mrr
 
     print(f"\nMRR Evaluation Statistics:")
     print(f"Total unique queries: {len(set(hum_ids))}")
@@ -248,5 +407,8 @@ def calculate_mrr(model, data_val, input_shape):
     print(f"Total queries: {len(hum_ids)}")
     print(f"Total songs in index: {len(song_ids)}")
     print(f"Final MRR: {mrr:.4f}")
+    for name, value in metrics.items():
+        if name != 'mrr':
+            print(f"{name}: {value:.4f}")
 
     return mrr